@@ -0,0 +1 @@
+from .massmail import Campaign, Mailer
@@ -1,216 +1,833 @@
 #!/usr/bin/env python3
+import array
+import base64
 import collections
+import copy
 import csv
+import datetime
 import email
-import mimetypes
+import functools
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import pathlib
+import queue
 import re
-import smtplib
+import signal
+import struct
+import sys
+import threading
+import time
+import uuid
 
-import rich.prompt
-import rich.panel
-import rich.progress
 from rich import print as rprint
 import click
-import email_validator
+
+# slow to import modules (concurrent.futures, email.message, email_validator,
+# mimetypes, rich.panel, rich.progress, rich.prompt and smtplib) are imported
+# only where they are needed: we don't want to pay for them at startup when
+# we just print the help or fail validating the command line
 
 
 KEYREGX = re.compile(r'(\$\w+\$)+')
 ATTACHMENT_TYPE = click.Path(exists=True, dir_okay=False, readable=True, path_type=pathlib.Path)
 FILETYPE = click.Path(exists=True, dir_okay=False, allow_dash=True, path_type=pathlib.Path)
+INFILE_TYPE = click.Path(exists=True, dir_okay=False, readable=True, path_type=pathlib.Path)
+# maximum number of rows handed over to a worker process at once when rendering in parallel
+RENDER_CHUNKSIZE = 64
+# attachments at least this large in bytes are not loaded in memory, but
+# base64-encoded on the fly while sending, see Stream
+STREAM_THRESHOLD = 1024*1024
+# bytes of an attachment encoded at once while streaming: a multiple of 57,
+# the number of bytes encoded in a line of 76 base64 characters
+STREAM_CHUNKSIZE = 57*1024
+# number of errors in a row after which a relay is not used anymore
+RELAY_MAX_FAILURES = 3
+# seconds after which a disabled relay is tried again by serve, see Relay.revive
+RELAY_COOLDOWN = 60
+# weight of the last message in the moving average of the time needed to send
+LATENCY_WEIGHT = 0.2
+# sending a message is considered stalling when it takes STALL_FACTOR times
+# longer than the average, and at least STALL_MIN seconds
+STALL_FACTOR = 5
+STALL_MIN = 1.0
+# the ways we can hand over messages, given as scheme of the server, see
+# server_login and transport.py
+TRANSPORTS = ('smtp', 'smtps', 'lmtp', 'sendmail', 'file', 'null')
+# timeouts in seconds to connect to the server, to get a reply to a command,
+# and to send the message body and get it accepted
+Timeouts = collections.namedtuple('Timeouts', ('connect', 'command', 'data'))
+DEFAULT_TIMEOUTS = Timeouts(connect=30, command=120, data=600)
+# how rows are assigned to shards, see in_shard
+SHARD_BY = ('row', 'email')
+# formats of the parameter file, and the extensions to guess them from. Files
+# with other extensions are CSV
+PARAMETER_FORMATS = ('csv', 'jsonl', 'sqlite')
+JSONL_SUFFIXES = ('.jsonl', '.ndjson')
+SQLITE_SUFFIXES = ('.db', '.sqlite', '.sqlite3')
+# number of distinct address headers and addresses kept already parsed, see
+# address_header and normalize_email_address
+ADDRESS_CACHE_SIZE = 4096
+# number of characters used to guess the dialect of a CSV file
+SNIFF_SIZE = 64*1024
+# format of the file written by --state
+STATE_VERSION = 1
+# default maximum size in bytes of a single message for --check
+MAX_MESSAGE_SIZE = 10*1024*1024
+# how to handle duplicate addresses in the parameter file, see validate_rows
+DEDUPE_POLICIES = ('warn', 'first', 'error')
+# on-disk layout of a suppression index: magic, number of slots, number of
+# addresses, followed by the slots of the hash table
+SUPPRESSION_MAGIC = b'MMSUPIX1'
+SUPPRESSION_HEADER = struct.Struct('<8sQQ')
+SUPPRESSION_SLOT = struct.Struct('<Q')
+# marker for the options that must be set for every job in a jobs file
+REQUIRED = object()
+# all options known in a jobs file with their default value
+JOB_OPTIONS = {'from' : REQUIRED, 'subject' : REQUIRED, 'server' : REQUIRED,
+               'parameter' : REQUIRED, 'body' : REQUIRED, 'bcc' : None, 'cc' : None,
+               'flip-bcc' : False, 'delimiter' : None, 'inreply-to' : None, 'user' : None,
+               'password' : None, 'attachment' : [], 'suppress' : None, 'dedupe' : 'warn',
+               'format' : None, 'query' : None, 'connect-timeout' : DEFAULT_TIMEOUTS.connect,
+               'command-timeout' : DEFAULT_TIMEOUTS.command, 'data-timeout' : DEFAULT_TIMEOUTS.data}
+
+
+def parse_parameter_file(parameter_file, delimiter=None, suppress=None, dedupe=None, shard=None,
+                         shard_by='row', fmt=None, query=None):
+    fieldnames, rows, first_line = read_parameter_file(parameter_file, delimiter, fmt, query)
+    return validate_rows(fieldnames, rows, parameter_name(parameter_file), first_line=first_line,
+                         suppress=suppress, dedupe=dedupe, shard=shard, shard_by=shard_by)
 
+def parameter_name(parameter_file):
+    # the name of the parameter file in messages
+    return '<stdin>' if str(parameter_file) == '-' else parameter_file.name
+
+def parameter_format(parameter_file, fmt=None, query=None):
+    # the format of the parameter file, guessed from its extension if not given
+    if fmt is None:
+        suffix = parameter_file.suffix.lower()
+        if query is not None or suffix in SQLITE_SUFFIXES:
+            fmt = 'sqlite'
+        elif suffix in JSONL_SUFFIXES:
+            fmt = 'jsonl'
+        else:
+            fmt = 'csv'
+    if fmt == 'sqlite' and query is None:
+        raise click.BadParameter(f'A query is needed to read rows from {parameter_name(parameter_file)}, '
+                                 'please specify one with -q!')
+    if fmt != 'sqlite' and query is not None:
+        raise click.BadParameter(f'A query can only be used with SQLite databases, not with {fmt}')
+    if fmt == 'sqlite' and str(parameter_file) == '-':
+        raise click.BadParameter('Can not read a SQLite database from stdin')
+    return fmt
 
-def parse_parameter_file(parameter_file, delimiter=None):
-    name = parameter_file.name
-    # sniff the CSV dialect, so that we can support different CSV formats
-    # always assume UTF8
-    parm = parameter_file.open('rt', encoding='utf8', errors='strict')
+def read_parameter_file(parameter_file, delimiter=None, fmt=None, query=None):
+    # return the field names, a generator of the rows and the line of the first
+    # row, for error messages. The rows are only read while consuming the
+    # generator. See parameter_format for fmt and query
+    fmt = parameter_format(parameter_file, fmt, query)
+    if fmt == 'sqlite':
+        return (*read_sqlite(parameter_file, query), 1)
+    if str(parameter_file) == '-':
+        # don't close stdin when done
+        parm = click.open_file('-', 'rt', encoding='utf8', errors='strict')
+    else:
+        # always assume UTF8
+        parm = parameter_file.open('rt', encoding='utf8', errors='strict')
+    if fmt == 'jsonl':
+        return (*read_jsonl(parm, parameter_name(parameter_file)), 1)
+    return (*read_csv(parm, delimiter), 2)
+
+def read_csv(parm, delimiter=None):
+    # sniff the CSV dialect, so that we can support different CSV formats.
+    # Only a sample at the beginning of the file is used, which is then read
+    # again by the CSV reader: this also works with stdin, where we can not seek
     if delimiter is None:
+        sample = parm.read(SNIFF_SIZE) + parm.readline()
         try:
-            dialect = csv.Sniffer().sniff(parm.read())
+            dialect = csv.Sniffer().sniff(sample)
             reader_opts = {'dialect' : dialect}
-            parm.seek(0)
         except (csv.Error, ValueError) as exc:
+            parm.close()
             raise click.BadParameter(f'Could not automatically guess CSV format, please specify the deilimiter with -d!')
+        lines = itertools.chain(sample.splitlines(keepends=True), parm)
     else:
         reader_opts = {'delimiter' : delimiter}
-    reader = csv.DictReader(parm, **reader_opts) #delimiter=';')
+        lines = parm
+    reader = csv.DictReader(lines, **reader_opts) #delimiter=';')
+
+    def rows():
+        with parm:
+            yield from reader
+    return reader.fieldnames, rows()
+
+def column_key(name):
+    # columns of JSON objects and SQLite queries can be named like keys, e.g.
+    # "$EMAIL$", or plainly, e.g. "email", which is the same as "$EMAIL$"
+    if name.startswith('$') and name.endswith('$') and len(name) > 1:
+        return name
+    return f'${name.upper()}$'
 
+def column_value(value):
+    # values are kept as they are, so that $EMAIL$ and $ATTACHMENT$ can be JSON
+    # lists, except for null (JSON) and NULL (SQLite) meaning an empty value
+    return '' if value is None else value
+
+def read_jsonl(parm, name):
+    # every line is a JSON object: the keys of the first one are the field names
+    def parse(line, count):
+        try:
+            obj = json.loads(line)
+        except ValueError as err:
+            raise click.ClickException(f'Line {count} in {name} is not valid JSON: {err}')
+        if not isinstance(obj, dict):
+            raise click.ClickException(f'Line {count} in {name} is not a JSON object')
+        return {column_key(key) : column_value(value) for key, value in obj.items()}
+
+    # blank lines, e.g. at the end of the file, are skipped
+    lines = ((count, line) for count, line in enumerate(parm, start=1) if line.strip())
+    try:
+        count, line = next(lines)
+        first = parse(line, count)
+    except StopIteration:
+        parm.close()
+        return [], iter(())
+    except click.ClickException:
+        parm.close()
+        raise
+
+    def rows():
+        with parm:
+            yield first
+            for count, line in lines:
+                yield parse(line, count)
+    return list(first), rows()
+
+def read_sqlite(path, query):
+    # run the query on the database, opened read-only: the columns of the result
+    # are the field names
+    import sqlite3
+
+    name = path.name
+    try:
+        db = sqlite3.connect(f'{path.resolve().as_uri()}?mode=ro', uri=True)
+    except sqlite3.Error as err:
+        raise click.ClickException(f'Can not open {name}: {err}')
+    try:
+        cursor = db.execute(query)
+    except sqlite3.Error as err:
+        db.close()
+        raise click.ClickException(f'Could not run query on {name}: {err}')
+    fieldnames = [column_key(column[0]) for column in cursor.description or ()]
+
+    def rows():
+        try:
+            for values in cursor:
+                yield dict(zip(fieldnames, map(column_value, values)))
+        except sqlite3.Error as err:
+            raise click.ClickException(f'Could not read rows from {name}: {err}')
+        finally:
+            db.close()
+    return fieldnames, rows()
+
+
+def validate_rows(fieldnames, rows, name, first_line=2, suppress=None, dedupe=None, shard=None,
+                  shard_by='row'):
+    # rows is an iterable of dictionaries {$KEY$ : value}, for example the rows of
+    # a csv.DictReader. The line numbers in the error messages start at first_line,
+    # which is 2 for CSV files because the first line is the header.
+    # Addresses whose key is in suppress are removed from the rows. Addresses
+    # already found in previous rows are handled according to dedupe:
+    # - None: don't look for duplicates at all
+    # - 'warn': print a warning for every duplicate
+    # - 'first': only keep the first occurrence of every address
+    # - 'error': fail on the first duplicate
+    # Rows with no address left are skipped altogether.
+    # With shard=(k, n) only the rows of the k-th of n shards are kept, see in_shard
+    check_fieldnames(fieldnames, name)
+
+    items = []
+    suppressed = duplicates = skipped = 0
+    # the line where every address key has been seen first
+    seen = {}
+    for count, row in enumerate(rows):
+        line = count + first_line
+        # don't waste time validating rows of other shards
+        if shard is not None and shard_by == 'row' and not in_shard(count, (), shard, shard_by):
+            continue
+        item = validate_row(fieldnames, row, f'Line {line} in {name} malformed')
+        addresses = item['$EMAIL$']
+        if shard is not None and shard_by == 'email':
+            keys = [address_key(email) for _, email in addresses]
+            if not in_shard(count, keys, shard, shard_by):
+                continue
+        if suppress is not None:
+            found = len(addresses)
+            addresses = [(display_name, email) for display_name, email in addresses
+                         if address_key(email) not in suppress]
+            suppressed += found - len(addresses)
+        if dedupe is not None:
+            unique = []
+            for display_name, email in addresses:
+                addr_key = address_key(email)
+                if addr_key not in seen:
+                    seen[addr_key] = line
+                    unique.append((display_name, email))
+                elif dedupe == 'error':
+                    raise click.ClickException(f'Line {line} in {name}: duplicate address {email} '
+                                               f'already found on line {seen[addr_key]}')
+                elif dedupe == 'warn':
+                    rprint(f'[bold][red]WARNING:[/red][/bold] Line {line} in {name}: duplicate address '
+                           f'[bold]{email}[/bold] already found on line {seen[addr_key]}')
+                    unique.append((display_name, email))
+                else:
+                    duplicates += 1
+            addresses = unique
+        if not addresses:
+            # all addresses have been suppressed or were duplicates
+            skipped += 1
+            continue
+        item['$EMAIL$'] = ','.join(format_email_address(*address) for address in addresses)
+        items.append(item)
+
+    if suppressed:
+        rprint(f'[bold]Suppressed {suppressed} address(es) found in the suppression list[/bold]')
+    if duplicates:
+        rprint(f'[bold]Removed {duplicates} duplicate address(es)[/bold]')
+    if skipped:
+        rprint(f'[bold]Skipped {skipped} row(s) with no address left[/bold]')
+    return fieldnames, items
+
+def in_shard(count, keys, shard, shard_by):
+    # whether the row with index count (starting at 0) and address keys belongs
+    # to the shard (k, n). Rows are assigned to shards either round robin or
+    # by a hash of their first address, so that rows with the same first
+    # address end up in the same shard, where --dedupe detects them. An address
+    # found in other positions of other rows may still be in several shards
+    k, n = shard
+    if shard_by == 'row':
+        index = count
+    else:
+        index = _address_hash(keys[0]) if keys else 0
+    return index % n == k - 1
+
+def check_fieldnames(fieldnames, name):
     # fail immediately if no EMAIL keyword is found
-    if '$EMAIL$' not in reader.fieldnames:
+    if '$EMAIL$' not in fieldnames:
         raise click.ClickException(f'No $EMAIL$ keyword found in {name}')
 
     # check that all keywords start and finish with a '$' character
-    for key in reader.fieldnames:
+    for key in fieldnames:
         if not key.startswith('$') or not key.endswith('$'):
             raise click.ClickException(f'Keyword {key=} malformed in {name}: should be $KEY$')
 
-    items = []
-    for count, row in enumerate(reader):
-        errstr = f'Line {count+2} in {name} malformed'
-        # verify that we don't have too many values
-        if None in row:
-            raise click.ClickException(f'{errstr}: {len(row.values())} found instead of {len(reader.fieldnames)}')
-        # verify that we are not missing values
-        if None in row.values():
-            values = list(row.values())
-            values.remove(None)
-            raise click.ClickException(f'{errstr}: {len(values)} found instead of {len(reader.fieldnames)}')
-        item = {}
-        for key, value in row.items():
-            value_str = value.strip()
-            # validate email addresses
-            if key == '$EMAIL$':
-                validated_emails = [validate_email_address(email.strip(), errstr) for email in value_str.split(',')]
-                value_str = ','.join(validated_emails)
-            elif key == '$ATTACHMENT$':
-                attachments = []
-                # verify attachments
-                for attachment in value_str.split(','):
-                    # fails here if it does not exist
-                    attachments.append(ATTACHMENT_TYPE(attachment))
-                value_str = attachments
-            item[key] = value_str
-        items.append(item)
+def validate_row(fieldnames, row, errstr):
+    # return the validated row: $EMAIL$ is a list of (display name, normalized
+    # address) and $ATTACHMENT$ a list of paths
+    # verify that we don't have too many values (csv.DictReader collects
+    # the extra values under the key None)
+    if len(row) > len(fieldnames):
+        raise click.ClickException(f'{errstr}: {len(row.values())} found instead of {len(fieldnames)}')
+    # verify that we are not missing values
+    values = [row.get(key) for key in fieldnames]
+    if None in values:
+        found = len(values) - values.count(None)
+        raise click.ClickException(f'{errstr}: {found} found instead of {len(fieldnames)}')
+    item = {}
+    for key, value in zip(fieldnames, values):
+        # email addresses and attachments can also be given as lists
+        # instead of comma separated strings
+        if key == '$EMAIL$':
+            # validate email addresses, an empty list fails like an empty cell
+            emails = _split(value, key, errstr) or ['']
+            value = [normalize_email_address(email.strip(), errstr) for email in emails]
+        elif key == '$ATTACHMENT$':
+            attachments = []
+            # verify attachments
+            for attachment in _split(value, key, errstr):
+                # fails here if it does not exist
+                attachments.append(ATTACHMENT_TYPE(attachment.strip()))
+            value = attachments
+        else:
+            value = str(value).strip()
+        item[key] = value
+    return item
 
-    return reader.fieldnames, items
+def _split(value, key, errstr):
+    # values of JSON Lines and SQLite rows can be of any type
+    if isinstance(value, str):
+        return value.strip().split(',')
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        return value
+    raise click.ClickException(f'{errstr}: {key} must be a string or a list of strings')
 
 
 def parse_body(body_file, keys):
+    body_text = body_file.read_text(encoding='utf8', errors='strict')
+    return check_body(body_text, keys, body_file.name)
+
+def check_body(body_text, keys, name, warn=True):
     # expected keys from the parameter file
     parm_keys = set(keys)
     # keys found in the body
-    body_text = body_file.read_text(encoding='utf8', errors='strict')
     body_keys = set(KEYREGX.findall(body_text))
 
-    if len(body_keys) == 0:
-        rprint(f'[bold][red]WARNING:[/red] no keys found in body file {body_file.name}[/bold]')
+    if len(body_keys) == 0 and warn:
+        rprint(f'[bold][red]WARNING:[/red] no keys found in body file {name}[/bold]')
     # check that there are no unkown keys in the body
     if diff := (body_keys - parm_keys):
-        raise click.ClickException(f'Unknown key(s) in body file {body_file.name}: {diff}')
+        raise click.ClickException(f'Unknown key(s) in body file {name}: {diff}')
 
     return body_text
 
 
 def format_attachment(path):
+    import mimetypes
     # guess the MIME type based on file extension only...
     mime, encoding = mimetypes.guess_type(path, strict=False)
     # if no guess or if the type is already encoded, the MIME type is octet-stream
     if mime is None or encoding is not None:
         mime = 'application/octet-stream'
     maintype, subtype = mime.split('/', 1)
+    # large files are kept on disk and streamed when sending, see Stream
+    if path.stat().st_size >= STREAM_THRESHOLD:
+        return path, maintype, subtype
     data = path.read_bytes()
     return data, maintype, subtype
 
+def add_attachment(msg, data, name, maintype, subtype):
+    # data is either bytes or the path of a file to be streamed: in that case
+    # we attach a unique placeholder, replaced by the content of the file by
+    # render_message. The placeholders are recorded in msg.streamed
+    if not isinstance(data, pathlib.Path):
+        msg.add_attachment(data, filename=name, maintype=maintype, subtype=subtype)
+        return
+    token = f'MASSMAILSTREAM{uuid.uuid4().hex}'
+    msg.add_attachment(b'', filename=name, maintype=maintype, subtype=subtype)
+    # the part keeps its Content-Transfer-Encoding: base64 header
+    list(msg.iter_attachments())[-1].set_payload(token)
+    if not hasattr(msg, 'streamed'):
+        msg.streamed = {}
+    msg.streamed[token] = data
+
 def collect_attachments(attachments):
     # collect global attachments once and then attach them to every single message
     return {path.name : format_attachment(path) for path in attachments}
 
-def create_email_bodies(body_text, items, fromh, subject, cc, bcc, inreply_to, attachments, flip_bcc):
+def build_message(body_text, item, fromh, subject, cc, bcc, inreply_to, attachments, to_header):
+    # find keywords and substitute with values
+
+    # The following line does this:
+    # - Assume that the parameter file has an header like
+    #     $NAME$;$SURNAME$;$EMAIL$
+    # - Assume that line "i" from the parameter file look like this
+    #     Gorilla; Blushing; email@gorillas.org
+    # - Then the following like is equivalent to having a loop over the keys
+    #   from the parameter file: ($NAME$, $SURNAME$)
+    # - The m in the lambda is going to be the re.match object for $NAME$ at the
+    #   first iteration, and the re.match object for $SURNAME$ at the second one
+    # - at every iteration, m.group(0) is the string of the matching key, i.e.
+    #   it is "$NAME$" at the first iteration and "$SURNAME$" at the second one
+    # - keys[m.group(0)] is then equivalent, at the first iteration, to
+    #     keys["$NAME$"] == ["Gorilla", "Othername1", "Othername2"]
+    # - keys[.group(0)][i] is then equivalent, at the first iteration, to
+    #     keys["$NAME$"][i] == "Gorilla"
+    #   if we assume that "Gorilla" is on line i
+    # - at the second iteration, we will have:
+    #   keys[m.group(0)] == keys["$SURNAME$"] == ["Blushing", "Othersurname1",....]
+    #   keys[m.group(0)][i] = keys["$SURNAME$"][i] == "Blushing"
+    # - we only have two iterations for re.sub, because we only have two keys
+    #   in the body matching the regexp r'\$\w+\$'
+    # - so at the end all the values corresponding to the keys will be inserted
+    #   into the body_text in place of the key
+    # - at the next iteration of i, we are going to select a different line from
+    #   the parameter file, and generate a new email with different substitutions
+    import email.message
+    import email.utils
+
+    body = KEYREGX.sub(lambda m: item[m.group(0)], body_text)
+    msg = email.message.EmailMessage()
+    try:
+        # check if the body is pure ASCII
+        body.encode('ascii')
+        # then pass it as is to the email module machinery
+        msg.set_content(body)
+    except UnicodeEncodeError:
+        # force CTE to be base64, so that we do not incur into strange unicode bugs
+        # like for example:
+        # https://github.com/python/cpython/issues/105285
+        msg.set_content(body, charset='utf-8', cte='base64')
+    # address headers are parsed once per distinct value, see address_header
+    msg[to_header] = address_header(to_header, item['$EMAIL$'])
+    msg['From'] = address_header('From', fromh)
+    msg['Subject'] = subject
+    if inreply_to:
+        msg['In-Reply-To'] = inreply_to
+    if cc:
+        msg['Cc'] = address_header('Cc', cc)
+    if bcc:
+        if 'Bcc' in msg:
+            new_bcc = ','.join((msg['Bcc'], bcc))
+            msg.replace_header('Bcc', address_header('Bcc', new_bcc))
+        else:
+            msg['Bcc'] = address_header('Bcc', bcc)
+    # add the required date header
+    msg['Date'] = email.utils.localtime()
+    # add a unique message-id
+    msg['Message-ID'] = email.utils.make_msgid()
+    # add attachments
+    for name, (data, mtyp, styp) in attachments.items():
+        add_attachment(msg, data, name, mtyp, styp)
+    # now add attachments that were specified in the parm file
+    if '$ATTACHMENT$' in item:
+        for path in item['$ATTACHMENT$']:
+            data, mtyp, styp = format_attachment(path)
+            add_attachment(msg, data, path.name, mtyp, styp)
+    return msg
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def address_header(name, value):
+    # the header object for a list of already validated addresses. Assigning
+    # it to a message stores it as it is, while assigning a string makes the
+    # email policy parse the address list again for every message. Rows
+    # sharing the same addresses, and the From, Cc and Bcc headers, which are
+    # the same for all messages, share a single header object
+    import email.policy
+
+    return email.policy.default.header_factory(name, value)
+
+def create_email_bodies(body_text, items, fromh, subject, cc, bcc, inreply_to, attachments, flip_bcc,
+                        confirm=True):
     to_header = 'Bcc' if flip_bcc else 'To'
     for i, item in enumerate(items):
-        # find keywords and substitute with values
-
-        # The following line does this:
-        # - Assume that the parameter file has an header like
-        #     $NAME$;$SURNAME$;$EMAIL$
-        # - Assume that line "i" from the parameter file look like this
-        #     Gorilla; Blushing; email@gorillas.org
-        # - Then the following like is equivalent to having a loop over the keys
-        #   from the parameter file: ($NAME$, $SURNAME$)
-        # - The m in the lambda is going to be the re.match object for $NAME$ at the
-        #   first iteration, and the re.match object for $SURNAME$ at the second one
-        # - at every iteration, m.group(0) is the string of the matching key, i.e.
-        #   it is "$NAME$" at the first iteration and "$SURNAME$" at the second one
-        # - keys[m.group(0)] is then equivalent, at the first iteration, to
-        #     keys["$NAME$"] == ["Gorilla", "Othername1", "Othername2"]
-        # - keys[.group(0)][i] is then equivalent, at the first iteration, to
-        #     keys["$NAME$"][i] == "Gorilla"
-        #   if we assume that "Gorilla" is on line i
-        # - at the second iteration, we will have:
-        #   keys[m.group(0)] == keys["$SURNAME$"] == ["Blushing", "Othersurname1",....]
-        #   keys[m.group(0)][i] = keys["$SURNAME$"][i] == "Blushing"
-        # - we only have two iterations for re.sub, because we only have two keys
-        #   in the body matching the regexp r'\$\w+\$'
-        # - so at the end all the values corresponding to the keys will be inserted
-        #   into the body_text in place of the key
-        # - at the next iteration of i, we are going to select a different line from
-        #   the parameter file, and generate a new email with different substitutions
-        body = KEYREGX.sub(lambda m: item[m.group(0)], body_text)
-        msg = email.message.EmailMessage()
-        try:
-            # check if the body is pure ASCII
-            body.encode('ascii')
-            # then pass it as is to the email module machinery
-            msg.set_content(body)
-        except UnicodeEncodeError:
-            # force CTE to be base64, so that we do not incur into strange unicode bugs
-            # like for example:
-            # https://github.com/python/cpython/issues/105285
-            msg.set_content(body, charset='utf-8', cte='base64')
-        msg[to_header] = item['$EMAIL$']
-        msg['From'] = fromh
-        msg['Subject'] = subject
-        if inreply_to:
-            msg['In-Reply-To'] = inreply_to
-        if cc:
-            msg['Cc'] = cc
-        if bcc:
-            if 'Bcc' in msg:
-                new_bcc = ','.join((msg['Bcc'], bcc))
-                msg.replace_header('Bcc', new_bcc)
-            else:
-                msg['Bcc'] = bcc
-        # add the required date header
-        msg['Date'] = email.utils.localtime()
-        # add a unique message-id
-        msg['Message-ID'] = email.utils.make_msgid()
-        # add attachments
-        for name, (data, mtyp, styp) in attachments.items():
-            msg.add_attachment(data, filename=name, maintype=mtyp, subtype=styp)
-        # now add attachments that were specified in the parm file
-        if '$ATTACHMENT$' in item:
-            for path in item['$ATTACHMENT$']:
-                data, mtyp, styp = format_attachment(path)
-                msg.add_attachment(data, filename=path.name, maintype=mtyp, subtype=styp)
-        if i == 0:
+        msg = build_message(body_text, item, fromh, subject, cc, bcc, inreply_to, attachments,
+                            to_header)
+        if i == 0 and confirm:
             # tease the first message
             tease(msg, len(items))
         yield msg
 
 
-def tease(msg, nmsgs):
-    panel = []
-    for hdr, value in msg.items():
-        if hdr in ('From', 'Subject', 'Cc', 'Bcc', 'In-Reply-To'):
-            panel.append(f'[yellow]{hdr}[/yellow]: [red bold]{value}[/red bold]')
+# a message already serialized and ready to be handed over to the SMTP server.
+# data is bytes, or a Stream for messages with large attachments
+Rendered = collections.namedtuple('Rendered', ('sender', 'recipients', 'to', 'data', 'mail_options'))
+
+class Stream:
+    """A serialized message whose large attachments are still on disk
+
+    segments are the serialized parts of the message (bytes, with CRLF line
+    endings) alternating with the paths of the attachments that go in between.
+    The attachments are memory mapped and base64-encoded STREAM_CHUNKSIZE bytes
+    at a time while sending, so that the memory needed per message does not
+    grow with their size. len() gives the size of the message in bytes.
+    """
+    def __init__(self, segments):
+        self.segments = segments
+
+    def __len__(self):
+        size = 0
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                size += len(segment)
+            else:
+                nbytes = segment.stat().st_size
+                # 4 characters for every 3 bytes, and a CRLF between lines of 76
+                size += -(-nbytes // 3) * 4 + max(0, -(-nbytes // 57) - 1) * 2
+        return size
+
+    def chunks(self, linesep=b'\r\n'):
+        """Generate the message in chunks of bytes, with the given line endings"""
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment if linesep == b'\r\n' else segment.replace(b'\r\n', linesep)
+                continue
+            with open(segment, 'rb') as fh:
+                if fh.seek(0, 2) == 0:
+                    # can not map an empty file
+                    continue
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    for start in range(0, len(data), STREAM_CHUNKSIZE):
+                        lines = base64.encodebytes(data[start:start+STREAM_CHUNKSIZE])
+                        # the line ending after the last line is already in
+                        # the next segment
+                        lines = lines[:-1].replace(b'\n', linesep)
+                        yield lines if start == 0 else linesep + lines
+
+def render_message(msg):
+    # this is what smtplib.SMTP.send_message does before talking to the server:
+    # extract the envelope from the headers, drop the Bcc header and flatten
+    # the message to bytes. We do it ourselves so that the expensive part can
+    # happen in a different process than the one sending the messages
+    sender = msg['Sender'] if 'Sender' in msg else msg['From']
+    sender = sender.addresses[0].addr_spec
+    # address headers already know their addresses, no need to parse them again
+    fields = [field for field in (msg['To'], msg['Bcc'], msg['Cc']) if field is not None]
+    recipients = [address.addr_spec for field in fields for address in field.addresses]
+    to = msg['To']
+    if 'Bcc' in msg or 'Resent-Bcc' in msg:
+        # keep the Bcc header of the original message, which may have to be
+        # rendered again if sending fails
+        msg = copy.copy(msg)
+        del msg['Bcc']
+        del msg['Resent-Bcc']
+    try:
+        ''.join([sender, *recipients]).encode('ascii')
+        policy, mail_options = msg.policy, ()
+    except UnicodeEncodeError:
+        policy, mail_options = msg.policy.clone(utf8=True), ('SMTPUTF8', 'BODY=8BITMIME')
+    data = msg.as_bytes(policy=policy.clone(linesep='\r\n'))
+    streamed = getattr(msg, 'streamed', None)
+    if streamed:
+        # split around the placeholders: tokens are at odd positions
+        segments = re.split(b'(' + b'|'.join(token.encode('ascii') for token in streamed) + b')', data)
+        segments[1::2] = [streamed[token.decode('ascii')] for token in segments[1::2]]
+        data = Stream(segments)
+    return Rendered(sender, recipients, to, data, mail_options)
+
+# the part of the work that is the same for every row, e.g. the message
+# template. It is set once per worker process by _init_worker, so that we don't
+# have to pickle the (possibly large) global attachments for every chunk of rows
+_WORKER_STATE = None
+
+def _init_worker(state):
+    global _WORKER_STATE
+    _WORKER_STATE = state
+
+def _render_chunk(chunk):
+    body_text, *headers = _WORKER_STATE
+    return [render_message(build_message(body_text, item, *headers)) for item in chunk]
+
+def render_email_bodies(body_text, items, fromh, subject, cc, bcc, inreply_to, attachments,
+                        flip_bcc, jobs, confirm=True):
+    # like create_email_bodies, but messages are built and serialized in a pool
+    # of worker processes, which receive chunks of rows and give back Rendered
+    # messages. The first message is built here, so that we can tease it
+    # before any worker is even started
+    import concurrent.futures
+
+    if not items:
+        return
+    to_header = 'Bcc' if flip_bcc else 'To'
+    template = (body_text, fromh, subject, cc, bcc, inreply_to, attachments, to_header)
+    first = build_message(body_text, items[0], *template[1:])
+    if confirm:
+        tease(first, len(items))
+    yield render_message(first)
+
+    rest = items[1:]
+    chunksize = max(1, min(RENDER_CHUNKSIZE, len(rest) // jobs))
+    chunks = (rest[i:i+chunksize] for i in range(0, len(rest), chunksize))
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                  initializer=_init_worker,
+                                                  initargs=(template,))
+    try:
+        # keep only a few chunks in flight, so that we don't accumulate
+        # serialized messages in memory if the server is slower than us
+        pending = collections.deque(pool.submit(_render_chunk, chunk)
+                                    for chunk in itertools.islice(chunks, 2*jobs))
+        while pending:
+            rendered = pending.popleft().result()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.submit(_render_chunk, chunk))
+            # results are collected in submission order, so messages are sent
+            # in the same order as the rows in the parameter file
+            yield from rendered
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def check_files(parameter_file, body_file, fromh, subject, cc, bcc, inreply_to, attachments,
+                flip_bcc, delimiter=None, suppress=None, dedupe=None, max_size=MAX_MESSAGE_SIZE,
+                jobs=1, shard=None, shard_by='row', fmt=None, query=None):
+    # validate everything like parse_parameter_file and parse_body do, but
+    # without stopping at the first problem. Every row is also rendered to check
+    # the size of the resulting message. Return a list of problems, each a
+    # dictionary {'file', 'line', 'error'}, where line is None for problems that
+    # don't belong to a single row. With jobs > 1 the rows are checked in chunks
+    # by a pool of worker processes
+    name = parameter_name(parameter_file)
+    try:
+        fieldnames, rows, first_line = read_parameter_file(parameter_file, delimiter, fmt, query)
+        check_fieldnames(fieldnames, name)
+    except click.ClickException as err:
+        # no way to check the rows
+        return [{'file' : name, 'line' : None, 'error' : err.format_message()}]
+
+    problems = []
+    body_text = body_file.read_text(encoding='utf8', errors='strict')
+    try:
+        check_body(body_text, fieldnames, body_file.name, warn=False)
+    except click.ClickException as err:
+        problems.append({'file' : body_file.name, 'line' : None, 'error' : err.format_message()})
+        # we can not render messages with unknown keys
+        body_text = None
+
+    to_header = 'Bcc' if flip_bcc else 'To'
+    headers = (fromh, subject, cc, bcc, inreply_to, collect_attachments(attachments), to_header)
+    state = (fieldnames, name, body_text, headers, max_size)
+    # rows read before an error reading the file are still checked
+    read_errors = []
+    numbered = zip(itertools.count(first_line), _stop_at_read_error(rows, read_errors))
+    if shard is not None and shard_by == 'row':
+        numbered = ((line, row) for line, row in numbered
+                    if in_shard(line-first_line, (), shard, shard_by))
+    chunks = iter(lambda: list(itertools.islice(numbered, RENDER_CHUNKSIZE)), [])
+    if jobs > 1:
+        import concurrent.futures
+
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+                                                      initializer=_init_worker,
+                                                      initargs=(state,))
+        results = pool.map(_check_chunk, chunks)
+    else:
+        pool = None
+        results = (check_rows(chunk, state) for chunk in chunks)
+
+    # the line where every address key has been seen first
+    seen = {}
+    try:
+        for line, error, keys in itertools.chain.from_iterable(results):
+            # rows with invalid addresses can not be assigned to a shard, so
+            # they are reported by every shard
+            if (shard is not None and shard_by == 'email' and keys
+                    and not in_shard(line-first_line, keys, shard, shard_by)):
+                continue
+            if error is not None:
+                problems.append({'file' : name, 'line' : line, 'error' : error})
+            for key in keys:
+                if suppress is not None and key in suppress:
+                    continue
+                if key in seen and dedupe == 'error':
+                    problems.append({'file' : name, 'line' : line,
+                                     'error' : f'duplicate address {key} already found on line {seen[key]}'})
+                seen.setdefault(key, line)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+    problems.extend({'file' : name, 'line' : None, 'error' : error} for error in read_errors)
+    return problems
+
+def _stop_at_read_error(rows, errors):
+    # generate the rows until the rest of the file can not be read, e.g. because
+    # it is not UTF8 encoded or invalid JSON, and append the error to errors
+    try:
+        yield from rows
+    except UnicodeDecodeError as err:
+        errors.append(f'not UTF8 encoded: {err}')
+    except click.ClickException as err:
+        errors.append(err.format_message())
+
+def check_rows(chunk, state):
+    # check a chunk of (line number, row) for check_files and return a list of
+    # (line number, error message or None, address keys)
+    fieldnames, name, body_text, headers, max_size = state
+    results = []
+    for line, row in chunk:
+        # a message that is too large still has valid addresses
+        keys = []
+        try:
+            item = validate_row(fieldnames, row, f'Line {line} in {name} malformed')
+            keys = [address_key(email) for _, email in item['$EMAIL$']]
+            if body_text is not None:
+                item['$EMAIL$'] = ','.join(format_email_address(*address) for address in item['$EMAIL$'])
+                size = len(render_message(build_message(body_text, item, *headers)).data)
+                if size > max_size:
+                    raise click.ClickException(f'Line {line} in {name}: message is {size} bytes, '
+                                               f'more than the limit of {max_size} bytes')
+        except click.ClickException as err:
+            results.append((line, err.format_message(), keys))
         else:
-            panel.append(f'[yellow]{hdr}[/yellow]: {value}')
-    for attachment in msg.iter_attachments():
-        name = attachment.get_filename()
-        content_type = attachment.get_content_type()
-        panel.append(f'[magenta]Attachment[/magenta] ([cyan]{content_type}[/cyan]): {name}')
-    body = msg.get_body().get_content()
-    panel.append(f'\n{body}')
-    rprint(rich.panel.Panel.fit('\n'.join(panel)))
+            results.append((line, None, keys))
+    return results
+
+def _check_chunk(chunk):
+    return check_rows(chunk, _WORKER_STATE)
+
+
+def tease(msg, nmsgs):
+    tease_campaigns([(msg, nmsgs)])
+
+def tease_campaigns(teasers):
+    # teasers is a list of (first message, number of messages), one for every
+    # campaign we are about to send: show them all and ask for confirmation once
+    import rich.panel
+    import rich.prompt
+
+    for msg, nmsgs in teasers:
+        panel = []
+        for hdr, value in msg.items():
+            if hdr in ('From', 'Subject', 'Cc', 'Bcc', 'In-Reply-To'):
+                panel.append(f'[yellow]{hdr}[/yellow]: [red bold]{value}[/red bold]')
+            else:
+                panel.append(f'[yellow]{hdr}[/yellow]: {value}')
+        for attachment in msg.iter_attachments():
+            name = attachment.get_filename()
+            content_type = attachment.get_content_type()
+            panel.append(f'[magenta]Attachment[/magenta] ([cyan]{content_type}[/cyan]): {name}')
+        body = msg.get_body().get_content()
+        panel.append(f'\n{body}')
+        rprint(rich.panel.Panel.fit('\n'.join(panel)))
+        if len(teasers) > 1:
+            rprint(f'[bold]{nmsgs} email messages like the one above[/bold]')
     # ask for confirmation before really sending stuff
-    rprint(f'[bold]About to send {nmsgs} email messages like the one above…[/bold]')
+    if len(teasers) == 1:
+        rprint(f'[bold]About to send {nmsgs} email messages like the one above…[/bold]')
+    else:
+        total = sum(nmsgs for _, nmsgs in teasers)
+        rprint(f'[bold]About to send {total} email messages in {len(teasers)} campaigns like the ones above…[/bold]')
     if not rich.prompt.Confirm.ask(f'[bold]Send?[/bold]'):
         # #if not click.confirm('Send the emails above?', default=None):
         raise click.ClickException('Aborted! We did not send anything!')
 
 
-def server_login(server, user, password):
-    servername = server.split(':')[0]
+def split_server(server):
+    # split a server into its scheme and address, e.g. "lmtp:///run/lmtp" gives
+    # ("lmtp", "/run/lmtp"). Servers without a scheme use smtp
+    scheme, sep, address = server.partition('://')
+    if not sep:
+        return 'smtp', server
+    if scheme not in TRANSPORTS:
+        raise click.BadParameter(f'unknown transport "{scheme}", use one of: {", ".join(TRANSPORTS)}')
+    return scheme, address
+
+def server_login(server, user, password, timeouts=DEFAULT_TIMEOUTS):
+    from . import transport
+
+    scheme, address = split_server(server)
+    servername = address.split(':')[0] if scheme in ('smtp', 'smtps') else address
+    if scheme == 'null':
+        return transport.FileSink()
+    elif scheme == 'file':
+        try:
+            return transport.FileSink(address)
+        except OSError as err:
+            raise click.ClickException(f'Can not write messages to "{address}": {err}')
+    elif scheme == 'sendmail':
+        server = transport.Sendmail(address or 'sendmail')
+        server.data_timeout = timeouts.data
+        return server
+
+    factory = {'smtp' : transport.SMTP, 'smtps' : transport.SMTPS, 'lmtp' : transport.LMTP}[scheme]
     try:
-        server = smtplib.SMTP(server)
+        if scheme == 'lmtp' and ':' in address:
+            # smtplib.LMTP only splits "host:port" when not given its default port
+            server = factory(address, 0, timeout=timeouts.connect)
+        else:
+            server = factory(address, timeout=timeouts.connect)
     except Exception as err:
         raise click.ClickException(f'Can not connect to "{servername}": {err}')
+    # from now on we are waiting for replies to commands
+    server.timeout = timeouts.command
+    server.sock.settimeout(timeouts.command)
+    server.data_timeout = timeouts.data
 
-    try:
-        server.starttls()
-    except Exception as err:
-        raise click.ClickException(f'Could not STARTTLS with "{servername}": {err}')
+    if scheme == 'smtp':
+        try:
+            server.starttls()
+        except Exception as err:
+            raise click.ClickException(f'Could not STARTTLS with "{servername}": {err}')
 
     if user is not None:
         try:
@@ -220,30 +837,583 @@ def server_login(server, user, password):
 
     return server
 
-def send_messages(msgs, server, nmsgs):
-    progress = rich.progress.Progress()
+def deliver(server, msg):
+    # send a message, either an EmailMessage or a Rendered one, and return the
+    # To header and a dictionary of the recipients refused by the server.
+    # We render messages ourselves instead of using send_message: smtplib
+    # would parse the address headers of every message again, and choke on
+    # the placeholders of the streamed attachments
+    if not isinstance(msg, Rendered):
+        msg = render_message(msg)
+    return msg.to, server.sendmail(msg.sender, msg.recipients, msg.data, msg.mail_options)
+
+def check_latency(latency, average, to):
+    # warn about a message that took much longer to send than the average so far
+    if average is not None and latency > STALL_FACTOR*average and latency > STALL_MIN:
+        rprint(f'[bold][red]WARNING:[/red][/bold] Sending to [bold]{to}[/bold] took {latency:.1f} s '
+               f'instead of {average:.1f} s on average, the server may be stalling')
+
+def send_messages(msgs, server, nmsgs, close=True, reconnect=None, show_progress=True, sent=None):
+    # reconnect is called to get a new connection when the server hangs up or
+    # times out, after which the message is sent once more. Without it, or if
+    # the message fails again, we abort. A message refused with a permanent
+    # error is skipped, like with send_messages_relays, and we fail at the end.
+    # sent is called with every message sent. Return the connection in use at
+    # the end
+    import smtplib
+    import rich.progress
+
+    # only one progress bar can be shown at once: see serve
+    progress = rich.progress.Progress(disable=not show_progress)
     track = progress.add_task("[green]Sending:[/green]", total=nmsgs)
+    # moving average of the time needed to send a message
+    average = None
+    refused = 0
     try:
         for idx, msg in enumerate(msgs):
             if idx == 0:
                 progress.start()
-            rprint(f"Sending to: [bold]{msg['To']}[/bold]")
+            to = msg.to if isinstance(msg, Rendered) else msg['To']
+            rprint(f"Sending to: [bold]{to}[/bold]")
+            start = time.monotonic()
             try:
-                out = server.send_message(msg)
+                try:
+                    _, out = deliver(server, msg)
+                except (TimeoutError, smtplib.SMTPServerDisconnected) as err:
+                    if reconnect is None:
+                        raise
+                    rprint(f'[bold][red]WARNING:[/red][/bold] Lost connection while sending to '
+                           f'[bold]{to}[/bold] ({type(err).__name__} {err}), reconnecting')
+                    try:
+                        server.close()
+                    except Exception:
+                        pass
+                    server = reconnect()
+                    start = time.monotonic()
+                    _, out = deliver(server, msg)
+            except click.ClickException:
+                raise
             except Exception as err:
                 text = f'{type(err).__name__} {err}'
-                raise click.ClickException(f'Can not send email: {text}')
+                if not permanent_error(err):
+                    raise click.ClickException(f'Can not send email: {text}')
+                rprint(f'[bold][red]WARNING:[/red][/bold] The server refused the message to '
+                       f'[bold]{to}[/bold]: {text}')
+                refused += 1
+                progress.update(track, advance=1)
+                continue
+            latency = time.monotonic() - start
+            check_latency(latency, average, to)
+            average = latency if average is None else average + LATENCY_WEIGHT*(latency - average)
 
             # out is a dictionary containing non-fatal SMTP errors (for example 550
             # if one of the recipients is unknown to the server)
             # we don't want to bail here, because other messages could still be fine
             if len(out) != 0:
-                rprint(f'[bold][red]WARNING:[/red][/bold] Problems sending to [bold]{msg["To"]}[/bold]'
+                rprint(f'[bold][red]WARNING:[/red][/bold] Problems sending to [bold]{to}[/bold]'
                        f' (ERROR: {out})')
+            if sent is not None:
+                sent(msg)
             progress.update(track, advance=1)
     finally:
         progress.stop()
-        server.quit()
+        if close:
+            server.quit()
+    if refused:
+        raise click.ClickException(f'Can not send email: {refused} message(s) refused, '
+                                   'see the warnings above')
+    return server
+
+
+class Relay:
+    """An SMTP server to send messages through, with its idle connections and statistics
+
+    weight is the number of connections opened in parallel to the server, see
+    send_messages_relays.
+    """
+    def __init__(self, server, user=None, password=None, weight=1, timeouts=DEFAULT_TIMEOUTS):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.weight = weight
+        self.timeouts = timeouts
+        self.sent = 0
+        # messages refused with a permanent error, which are not the relay's fault
+        self.refused = 0
+        self.errors = 0
+        # number of errors in a row, reset by every successful send
+        self.failures = 0
+        # moving average of the time in seconds needed to send a message
+        self.latency = None
+        self.disabled = False
+        # when the relay was disabled, as given by time.monotonic
+        self.disabled_at = None
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # return an idle connection if the server didn't hang up on it, or a new one
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            try:
+                connection.noop()
+                return connection
+            except Exception:
+                pass
+        return server_login(self.server, self.user, self.password, self.timeouts)
+
+    def release(self, connection):
+        # keep the connection around for the next campaign
+        with self._lock:
+            self._idle.append(connection)
+
+    def record(self, latency=None, error=None):
+        with self._lock:
+            if error is None:
+                self.sent += 1
+                self.failures = 0
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency += LATENCY_WEIGHT * (latency - self.latency)
+            else:
+                self.errors += 1
+                self.failures += 1
+                if self.failures >= RELAY_MAX_FAILURES and not self.disabled:
+                    self.disabled = True
+                    self.disabled_at = time.monotonic()
+
+    def refuse(self):
+        with self._lock:
+            self.refused += 1
+
+    def revive(self, cooldown=RELAY_COOLDOWN):
+        # use a disabled relay again once it had cooldown seconds to recover
+        with self._lock:
+            if self.disabled and time.monotonic() - self.disabled_at >= cooldown:
+                self.disabled = False
+                self.failures = 0
+
+    def close(self):
+        while self._idle:
+            try:
+                self._idle.pop().quit()
+            except Exception:
+                pass
+
+def parse_relay(spec, user=None, password=None, timeouts=DEFAULT_TIMEOUTS):
+    # a relay is given as "[scheme://]address[,weight=N][,user=USER][,password=PASSWORD]"
+    # user and password are the defaults for relays that don't set their own
+    server, *opts = spec.split(',')
+    split_server(server.strip())
+    relay = Relay(server.strip(), user, password, timeouts=timeouts)
+    for opt in opts:
+        key, _, value = opt.partition('=')
+        key = key.strip()
+        if key == 'weight':
+            if not value.strip().isdigit() or int(value) < 1:
+                raise click.BadParameter(f'weight must be a positive integer in {spec!r}')
+            relay.weight = int(value)
+        elif key in ('user', 'password'):
+            setattr(relay, key, value.strip())
+        else:
+            raise click.BadParameter(f'unknown relay option {key!r} in {spec!r}')
+    return relay
+
+def permanent_error(err):
+    # whether err is a permanent (5xx) refusal of a message by a working server,
+    # like unknown recipients or rejected content, which would be refused by
+    # any other relay too
+    import smtplib
+
+    if isinstance(err, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in err.recipients.values())
+    return isinstance(err, smtplib.SMTPResponseException) and err.smtp_code >= 500
+
+def send_messages_relays(msgs, relays, nmsgs, show_progress=True, sent=None):
+    # like send_messages, but spread the messages among several relays. Every
+    # relay gets as many connections as its weight, each one served by a thread
+    # taking the next message from a shared queue: fast relays naturally send
+    # more messages than slow ones, and a stalled relay only holds up the
+    # messages it is sending right now. A message that fails is put back in
+    # the queue for the other relays, and a relay failing RELAY_MAX_FAILURES
+    # times in a row is not used anymore. A message refused with a permanent
+    # error is skipped instead, without counting against the relay. We give up
+    # when a message failed on every relay still in use, or when there is no
+    # relay left. sent is called with every message sent, from the threads
+    import rich.progress
+
+    progress = rich.progress.Progress(disable=not show_progress)
+    track = progress.add_task("[green]Sending:[/green]", total=nmsgs)
+    # items in the queue are (message, relays on which it failed), None tells
+    # the threads to exit
+    pending = queue.Queue()
+    cond = threading.Condition()
+    # inflight: messages in the queue or being sent; alive: running threads
+    state = {'inflight' : 0, 'alive' : 0, 'error' : None}
+
+    def msg_to(msg):
+        return msg.to if isinstance(msg, Rendered) else msg['To']
+
+    def finished(error=None):
+        with cond:
+            state['inflight'] -= 1
+            if error is not None and state['error'] is None:
+                state['error'] = error
+            cond.notify_all()
+
+    def lane(relay):
+        connection = None
+        try:
+            while (item := pending.get()) is not None:
+                msg, failed = item
+                if state['error'] is not None:
+                    # give up, we are about to abort anyway
+                    finished()
+                    continue
+                if relay.disabled:
+                    pending.put(item)
+                    break
+                if relay in failed:
+                    if all(other in failed or other.disabled for other in relays):
+                        # the relays that could still send it have been disabled meanwhile
+                        finished(f'Can not send email to {msg_to(msg)}: all relays failed')
+                    else:
+                        # let another relay try this one
+                        pending.put(item)
+                        time.sleep(0.01)
+                    continue
+                to = msg_to(msg)
+                start = time.monotonic()
+                try:
+                    if connection is None:
+                        connection = relay.acquire()
+                    _, out = deliver(connection, msg)
+                except Exception as err:
+                    if connection is not None and permanent_error(err):
+                        # the relay is fine, any other one would refuse the message too:
+                        # skip it and keep the connection, smtplib has reset it
+                        relay.refuse()
+                        rprint(f'[bold][red]WARNING:[/red][/bold] Relay [bold]{relay.server}[/bold] '
+                               f'refused the message to [bold]{to}[/bold]: {type(err).__name__} {err}')
+                        progress.update(track, advance=1)
+                        finished()
+                        continue
+                    relay.record(error=err)
+                    if isinstance(err, click.ClickException):
+                        text = err.format_message()
+                    else:
+                        text = f'{type(err).__name__} {err}'
+                    rprint(f'[bold][red]WARNING:[/red][/bold] Relay [bold]{relay.server}[/bold] could not '
+                           f'send to [bold]{to}[/bold]: {text}')
+                    if connection is not None:
+                        try:
+                            connection.quit()
+                        except Exception:
+                            pass
+                        connection = None
+                    failed = failed | {relay}
+                    if all(other in failed or other.disabled for other in relays):
+                        finished(f'Can not send email to {to}: {text}')
+                    else:
+                        pending.put((msg, failed))
+                    continue
+                latency = time.monotonic() - start
+                check_latency(latency, relay.latency, to)
+                relay.record(latency=latency)
+                rprint(f"Sent to: [bold]{to}[/bold] via {relay.server}")
+                if len(out) != 0:
+                    rprint(f'[bold][red]WARNING:[/red][/bold] Problems sending to [bold]{to}[/bold]'
+                           f' (ERROR: {out})')
+                if sent is not None:
+                    sent(msg)
+                progress.update(track, advance=1)
+                finished()
+        finally:
+            if connection is not None:
+                relay.release(connection)
+            with cond:
+                state['alive'] -= 1
+                if state['alive'] == 0 and state['inflight'] > 0 and state['error'] is None:
+                    state['error'] = 'Can not send email: all relays failed'
+                cond.notify_all()
+
+    threads = [threading.Thread(target=lane, args=(relay,), daemon=True)
+               for relay in relays if not relay.disabled for _ in range(relay.weight)]
+    # relays are kept for several campaigns: only count the refusals of this one
+    refused_before = sum(relay.refused for relay in relays)
+    if not threads:
+        # all relays have been disabled while sending a previous campaign
+        raise click.ClickException('Can not send email: all relays failed')
+    # don't render messages much faster than we can send them
+    limit = 2*len(threads)
+    try:
+        for idx, msg in enumerate(msgs):
+            if idx == 0:
+                # start sending only after the first message has been teased
+                progress.start()
+                state['alive'] = len(threads)
+                for thread in threads:
+                    thread.start()
+            with cond:
+                cond.wait_for(lambda: state['inflight'] < limit or state['error'] is not None)
+                if state['error'] is not None:
+                    break
+                state['inflight'] += 1
+            pending.put((msg, frozenset()))
+        with cond:
+            cond.wait_for(lambda: state['inflight'] == 0 or state['error'] is not None)
+    finally:
+        for thread in threads:
+            pending.put(None)
+        for thread in threads:
+            if thread.is_alive():
+                thread.join()
+        progress.stop()
+    for relay in relays:
+        latency = 'n/a' if relay.latency is None else f'{relay.latency*1000:.0f} ms'
+        status = ' [red](disabled)[/red]' if relay.disabled else ''
+        rprint(f'Relay [bold]{relay.server}[/bold]{status}: {relay.sent} sent, {relay.refused} refused, '
+               f'{relay.errors} errors, average latency {latency}')
+    if state['error'] is not None:
+        raise click.ClickException(state['error'])
+    if refused := sum(relay.refused for relay in relays) - refused_before:
+        raise click.ClickException(f'Can not send email: {refused} message(s) refused, '
+                                   'see the warnings above')
+
+
+class Campaign:
+    """A mass mail campaign: a body template filled in once for every row of parameters
+
+    keys is the list of $KEY$s and items the list of validated rows, as returned
+    by parse_parameter_file, and body the body text as returned by parse_body.
+    Use Campaign.from_rows to create a campaign out of a body and rows that have
+    not been validated yet, or Campaign.from_files to read them from files. A
+    click.ClickException is raised on the first problem found.
+    """
+    def __init__(self, fromh, subject, body, keys, items, cc=None, bcc=None, inreply_to=None,
+                 attachments=(), flip_bcc=False):
+        self.fromh = validate_email_address(fromh)
+        self.subject = subject
+        self.cc = cc and validate_email_address(cc)
+        self.bcc = bcc and validate_email_address(bcc)
+        self.inreply_to = validate_inreply_to(None, None, inreply_to)
+        self.flip_bcc = flip_bcc
+        self.keys = keys
+        self.items = items
+        self.body = body
+        self.attachments = collect_attachments(ATTACHMENT_TYPE(path) for path in attachments)
+
+    @classmethod
+    def from_rows(cls, fromh, subject, body, rows, keys=None, name='<rows>', suppress=None,
+                  dedupe=None, shard=None, shard_by='row', **kwargs):
+        """Create a campaign from an iterable of dictionaries {$KEY$ : value}
+
+        The values of $EMAIL$ and $ATTACHMENT$ can be either comma separated
+        strings or lists. keys defaults to the keys of the first row. Addresses
+        in suppress, as returned by load_suppression_list, are not sent to.
+        Duplicate addresses are handled according to dedupe and only the rows
+        of shard (k, n) are kept, see validate_rows.
+        """
+        rows = list(rows)
+        if keys is None:
+            keys = list(rows[0]) if rows else ['$EMAIL$']
+        keys, items = validate_rows(keys, rows, name, first_line=1, suppress=suppress, dedupe=dedupe,
+                                    shard=shard, shard_by=shard_by)
+        body = check_body(body, keys, '<body>')
+        return cls(fromh, subject, body, keys, items, **kwargs)
+
+    @classmethod
+    def from_files(cls, fromh, subject, parameter_file, body_file, delimiter=None, suppress=None,
+                   dedupe=None, shard=None, shard_by='row', fmt=None, query=None, **kwargs):
+        """Create a campaign from a parameter file and a body file
+
+        The parameter file is CSV, JSON Lines or a SQLite database to run query on, see
+        parameter_format. "-" is stdin.
+        """
+        keys, items = parse_parameter_file(parameter_file, delimiter, suppress, dedupe, shard, shard_by,
+                                           fmt, query)
+        body = parse_body(body_file, keys)
+        return cls(fromh, subject, body, keys, items, **kwargs)
+
+    def __len__(self):
+        return len(self.items)
+
+    def fingerprints(self):
+        """Return a (key, fingerprint) for every row
+
+        The key identifies the row by its addresses, the fingerprint is a hash of
+        everything that ends up in its message: the values of the row, the
+        body, the headers and the content of the attachments.
+        """
+        import email.utils
+
+        # attachments are hashed only once, even when used by many rows
+        digests = {}
+        def digest(data):
+            if isinstance(data, bytes):
+                return hashlib.blake2b(data, digest_size=16).hexdigest()
+            if data not in digests:
+                hasher = hashlib.blake2b(digest_size=16)
+                with open(data, 'rb') as fh:
+                    for chunk in iter(lambda: fh.read(1024*1024), b''):
+                        hasher.update(chunk)
+                digests[data] = hasher.hexdigest()
+            return digests[data]
+
+        common = [self.fromh, self.subject, self.cc, self.bcc, self.inreply_to, self.flip_bcc,
+                  self.body, sorted((name, digest(data), mtyp, styp)
+                                    for name, (data, mtyp, styp) in self.attachments.items())]
+        fingerprints = []
+        occurrences = collections.Counter()
+        for item in self.items:
+            addresses = email.utils.getaddresses([item['$EMAIL$']])
+            key = ','.join(sorted(address_key(addr) for _, addr in addresses))
+            # rows with the same addresses (allowed by dedupe='warn') are told
+            # apart by their order: the second one is "key#2" and so on
+            occurrences[key] += 1
+            if occurrences[key] > 1:
+                key = f'{key}#{occurrences[key]}'
+            values = sorted((name, [(path.name, digest(path)) for path in value]
+                             if name == '$ATTACHMENT$' else value) for name, value in item.items())
+            fingerprint = hashlib.blake2b(json.dumps([common, values]).encode('utf8'), digest_size=16)
+            fingerprints.append((key, fingerprint.hexdigest()))
+        return fingerprints
+
+    def preview(self):
+        """Build the first message of the campaign, to be shown to the user before sending"""
+        to_header = 'Bcc' if self.flip_bcc else 'To'
+        return build_message(self.body, self.items[0], self.fromh, self.subject, self.cc,
+                             self.bcc, self.inreply_to, self.attachments, to_header)
+
+    def messages(self, jobs=1, confirm=True):
+        """Generate the messages, teasing the first one and asking for confirmation if confirm is set"""
+        opts = (self.body, self.items, self.fromh, self.subject, self.cc, self.bcc,
+                self.inreply_to, self.attachments, self.flip_bcc)
+        if jobs > 1:
+            return render_email_bodies(*opts, jobs, confirm=confirm)
+        else:
+            return create_email_bodies(*opts, confirm=confirm)
+
+
+class Mailer:
+    """Connections to one or more SMTP relays to be reused for sending many campaigns
+
+    server is a relay specification (see parse_relay), a Relay, or a list of
+    them. With more than one relay, or a relay with a weight above 1, messages
+    are spread among the connections, see send_messages_relays. timeouts
+    applies to relays given as specifications. Connections are opened on the
+    first send and opened again if the server dropped them in between two
+    campaigns. Use it as a context manager, or call close() when done.
+    """
+    def __init__(self, server, user=None, password=None, timeouts=DEFAULT_TIMEOUTS):
+        servers = [server] if isinstance(server, (str, Relay)) else server
+        self.relays = [relay if isinstance(relay, Relay) else parse_relay(relay, user, password, timeouts)
+                       for relay in servers]
+
+    def send(self, campaign, jobs=1, confirm=True, limiter=None, show_progress=True, sent=None):
+        """Send all messages of a campaign, see Campaign.messages for jobs and confirm
+
+        Messages are sent no faster than allowed by limiter, a RateLimiter
+        which can be shared with other threads. sent is called with the index
+        in campaign.items of the row of every message sent, as soon as it is
+        sent: rows sent before a failure are known too.
+        """
+        msgs = campaign.messages(jobs=jobs, confirm=confirm)
+        if sent is not None:
+            msgs, sent = track_rows(msgs, sent)
+        if limiter is not None:
+            msgs = limiter.limit(msgs)
+        if len(self.relays) > 1 or self.relays[0].weight > 1:
+            send_messages_relays(msgs, self.relays, len(campaign), show_progress=show_progress,
+                                 sent=sent)
+            return
+        relay = self.relays[0]
+        connection = relay.acquire()
+        try:
+            connection = send_messages(msgs, connection, len(campaign), close=False,
+                                       reconnect=relay.acquire, show_progress=show_progress,
+                                       sent=sent)
+        finally:
+            # if we reconnected and failed afterwards, this is the old connection:
+            # no harm done, dead connections are dropped by the next acquire
+            relay.release(connection)
+
+    def close(self):
+        for relay in self.relays:
+            relay.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def track_rows(msgs, sent):
+    # the senders only know about messages: return msgs and a function calling
+    # sent with the index of a message in msgs instead
+    rows = {}
+
+    def indexed():
+        for idx, msg in enumerate(msgs):
+            rows[id(msg)] = idx
+            yield msg
+
+    def sent_msg(msg):
+        sent(rows.pop(id(msg)))
+    return indexed(), sent_msg
+
+class RateLimiter:
+    """Let at most rate messages per second through, even when shared among threads"""
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        # when the next message can go
+        self.next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            due = max(self.next, now)
+            self.next = due + self.interval
+        if due > now:
+            time.sleep(due - now)
+
+    def limit(self, msgs):
+        for msg in msgs:
+            self.wait()
+            yield msg
+
+
+def load_state(path):
+    # return the fingerprints of the rows sent in previous runs, see
+    # Campaign.fingerprints, as a dictionary {key : fingerprint}
+    if not path.exists():
+        return {}
+    try:
+        state = json.loads(path.read_text(encoding='utf8'))
+        if state.get('version') != STATE_VERSION:
+            raise ValueError(f'unknown version {state.get("version")!r}')
+        rows = state['rows']
+        if not isinstance(rows, dict):
+            raise ValueError('rows must be an object')
+        return rows
+    except (ValueError, KeyError, AttributeError, TypeError) as err:
+        raise click.ClickException(f'Could not read state file {path.name}: {err}')
+
+def save_state(path, fingerprints):
+    write_json(path, {'version' : STATE_VERSION, 'rows' : fingerprints})
+
+def write_json(path, data):
+    # replace the file at once, so that readers never see half of it and an
+    # interrupted run does not lose it
+    tmp = path.with_name(f'{path.name}.tmp')
+    tmp.write_text(json.dumps(data, indent=2), encoding='utf8')
+    os.replace(tmp, path)
+
 
 def validate_inreply_to(context, param, value):
     if value is None:
@@ -253,22 +1423,126 @@ def validate_inreply_to(context, param, value):
     return value
 
 def validate_email_address(email, errstr=''):
+    return format_email_address(*normalize_email_address(email, errstr))
+
+def normalize_email_address(email, errstr=''):
     # we support two kind of email address:
     # 1. x@y.org
     # 2. Blushing Gorilla <x@y.org>
+    # return the display name (possibly empty) and the normalized address
+    import email_validator
+
     try:
-        emailinfo = email_validator.validate_email(email,
-                                                   check_deliverability=False,
-                                                   allow_display_name=True)
+        return _validate_email(email)
     except email_validator.EmailNotValidError as e:
         raise click.BadParameter(errstr+f"{email!r} is not a valid email address:\n{str(e)}")
-    email = emailinfo.normalized
-    if emailinfo.display_name:
+
+@functools.lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _validate_email(email):
+    # addresses repeated in many rows, e.g. a Cc in every row, are validated once
+    import email_validator
+
+    emailinfo = email_validator.validate_email(email,
+                                               check_deliverability=False,
+                                               allow_display_name=True)
+    return emailinfo.display_name, emailinfo.normalized
+
+def format_email_address(display_name, email):
+    if display_name:
         # always quote display_name so we support UTF8 chars in it out of the box
-        return f'"{emailinfo.display_name}" <{email}>'
+        return f'"{display_name}" <{email}>'
     else:
         return email
 
+def address_key(email):
+    # the key used to compare normalized addresses: the domain is already
+    # lowercase after normalization, but people don't care about the case of
+    # the local part either
+    return email.lower()
+
+
+def load_suppression_list(path):
+    # return a container of address keys which should not receive anything:
+    # either a prebuilt SuppressionIndex or a set read from a plain list of
+    # email addresses, one per line
+    with path.open('rb') as fh:
+        magic = fh.read(len(SUPPRESSION_MAGIC))
+    if magic == SUPPRESSION_MAGIC:
+        return SuppressionIndex(path)
+    return set(read_address_list(path))
+
+def read_address_list(path):
+    # yield the address keys from a file with one email address per line.
+    # Empty lines and lines starting with '#' are ignored
+    with path.open('rt', encoding='utf8', errors='strict') as fh:
+        for count, line in enumerate(fh):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                _, email = normalize_email_address(line, f'Line {count+1} in {path.name} malformed: ')
+                yield address_key(email)
+
+def _address_hash(key):
+    digest = hashlib.blake2b(key.encode('utf8'), digest_size=SUPPRESSION_SLOT.size).digest()
+    # 0 marks empty slots in the hash table
+    return int.from_bytes(digest, 'little') or 1
+
+def build_suppression_index(keys, index):
+    # write a SuppressionIndex for the address keys to the file index. This is
+    # an open addressing hash table of 64 bit hashes of the keys, at most half
+    # full, so that lookups only need to probe a couple of slots on average
+    hashes = {_address_hash(key) for key in keys}
+    nslots = 8
+    while nslots < 2*len(hashes):
+        nslots *= 2
+    table = array.array('Q', bytes(SUPPRESSION_SLOT.size*nslots))
+    for value in hashes:
+        slot = value & (nslots - 1)
+        while table[slot]:
+            slot = (slot + 1) & (nslots - 1)
+        table[slot] = value
+    if sys.byteorder != 'little':
+        table.byteswap()
+    with index.open('wb') as fh:
+        fh.write(SUPPRESSION_HEADER.pack(SUPPRESSION_MAGIC, nslots, len(hashes)))
+        table.tofile(fh)
+    return len(hashes)
+
+class SuppressionIndex:
+    """A memory-mapped hash table of address keys, see build_suppression_index
+
+    Supports `key in index` in constant time without loading the table in memory.
+    """
+    def __init__(self, path):
+        with path.open('rb') as fh:
+            self._map = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < SUPPRESSION_HEADER.size:
+            self._corrupted(path)
+        _, self._nslots, self._count = SUPPRESSION_HEADER.unpack_from(self._map)
+        # lookups rely on a power of two of slots, at least one of them empty
+        if (self._nslots < 8 or self._nslots & (self._nslots - 1) or self._count >= self._nslots
+                or len(self._map) != SUPPRESSION_HEADER.size + SUPPRESSION_SLOT.size*self._nslots):
+            self._corrupted(path)
+
+    def _corrupted(self, path):
+        self._map.close()
+        raise click.ClickException(f'Suppression index {path.name} is corrupted')
+
+    def __contains__(self, key):
+        value = _address_hash(key)
+        mask = self._nslots - 1
+        slot = value & mask
+        while True:
+            stored, = SUPPRESSION_SLOT.unpack_from(self._map, SUPPRESSION_HEADER.size
+                                                              + SUPPRESSION_SLOT.size*slot)
+            if stored == value:
+                return True
+            if stored == 0:
+                return False
+            slot = (slot + 1) & mask
+
+    def __len__(self):
+        return self._count
+
 
 # a custom click parameter type to represent email addresses
 class Email(click.ParamType):
@@ -281,15 +1555,129 @@ class Email(click.ParamType):
         except click.BadParameter as e:
             self.fail(str(e), param, ctx)
 
-@click.command(context_settings={'help_option_names': ['-h', '--help'],
-                                 'max_content_width': 120})
+# a custom click parameter type to represent a shard K/N
+class Shard(click.ParamType):
+    name = "Shard"
+
+    def convert(self, value, param, ctx):
+        try:
+            k, n = (int(x) for x in value.split('/'))
+        except ValueError:
+            self.fail(f'{value!r} is not of the form K/N', param, ctx)
+        if not 1 <= k <= n:
+            self.fail(f'{value!r}: K must be between 1 and N', param, ctx)
+        return k, n
+
+def parse_jobs_file(jobs_file, overrides=None):
+    # a jobs file is a TOML file with a list of jobs in [[job]] tables. Every job
+    # accepts the options in JOB_OPTIONS, top level values are defaults for all
+    # jobs, and overrides (see job_overrides) have precedence over both.
+    # Relative paths are relative to the directory of the jobs file. Return the
+    # list of jobs, each a dict with all the options in JOB_OPTIONS
+    try:
+        import tomllib
+    except ImportError:
+        # python < 3.11
+        import tomli as tomllib
+
+    name = jobs_file.name
+    try:
+        with jobs_file.open('rb') as fh:
+            config = tomllib.load(fh)
+    except tomllib.TOMLDecodeError as err:
+        raise click.ClickException(f'Could not parse {name}: {err}')
+    defaults = {key : value for key, value in config.items() if key != 'job'}
+    if not config.get('job'):
+        raise click.ClickException(f'No [[job]] found in {name}')
+
+    basedir = jobs_file.parent
+    jobs = []
+    for count, job in enumerate(config['job']):
+        errstr = f'Job {count+1} in {name}'
+        job = {**JOB_OPTIONS, **defaults, **job, **(overrides or {})}
+        if unknown := set(job) - set(JOB_OPTIONS):
+            raise click.ClickException(f'{errstr}: unknown option(s) {unknown}')
+        if missing := [key for key, value in job.items() if value is REQUIRED]:
+            raise click.ClickException(f'{errstr}: missing option(s) {missing}')
+        if job['dedupe'] not in DEDUPE_POLICIES:
+            raise click.ClickException(f'{errstr}: dedupe must be one of {DEDUPE_POLICIES}')
+        if job['format'] not in (None, *PARAMETER_FORMATS):
+            raise click.ClickException(f'{errstr}: format must be one of {PARAMETER_FORMATS}')
+        for key in (f'{field}-timeout' for field in Timeouts._fields):
+            if isinstance(job[key], bool) or not isinstance(job[key], (int, float)) or job[key] <= 0:
+                raise click.ClickException(f'{errstr}: {key} must be a positive number of seconds')
+        try:
+            job['parameter'] = FILETYPE(basedir / job['parameter'])
+            job['body'] = FILETYPE(basedir / job['body'])
+            job['attachment'] = [ATTACHMENT_TYPE(basedir / path)
+                                 for path in _split(job['attachment'], 'attachment', errstr)]
+            if job['suppress'] is not None:
+                job['suppress'] = INFILE_TYPE(basedir / job['suppress'])
+        except click.BadParameter as err:
+            raise click.ClickException(f'{errstr}: {err}')
+        jobs.append(job)
+    return jobs
+
+def campaigns_from_jobs(jobs_list, name):
+    # validate all jobs of a jobs file and return their campaigns
+    campaigns = []
+    for count, job in enumerate(jobs_list):
+        try:
+            campaigns.append(campaign_from_job(job))
+        except click.ClickException as err:
+            raise click.ClickException(f'Job {count+1} in {name}: {err.format_message()}')
+    return campaigns
+
+def job_overrides(server, user, password):
+    # the options given on the command line of batch and serve for all jobs
+    return {key : value for key, value in (('server', server), ('user', user),
+                                           ('password', password)) if value is not None}
+
+def mailer_key(job):
+    # jobs with the same key can share a Mailer: the relay specifications, user,
+    # password and timeouts, in the order of the arguments of make_relays
+    servers = [job['server']] if isinstance(job['server'], str) else job['server']
+    return tuple(servers), job['user'], job['password'], job_timeouts(job)
+
+def job_timeouts(job):
+    return Timeouts(*(job[f'{field}-timeout'] for field in Timeouts._fields))
+
+def campaign_from_job(job):
+    suppress = job['suppress'] and load_suppression_list(job['suppress'])
+    return Campaign.from_files(job['from'], job['subject'], job['parameter'], job['body'],
+                               delimiter=job['delimiter'], fmt=job['format'],
+                               query=job['query'], suppress=suppress,
+                               dedupe=job['dedupe'], cc=job['cc'],
+                               bcc=job['bcc'], inreply_to=job['inreply-to'],
+                               attachments=job['attachment'], flip_bcc=job['flip-bcc'])
+
+CONTEXT_SETTINGS = {'help_option_names': ['-h', '--help'], 'max_content_width': 120}
+
+
+class DefaultGroup(click.Group):
+    # a group of commands that runs the "send" command when no command name is
+    # given, so that "massmail --from ..." keeps working as before
+    def parse_args(self, ctx, args):
+        if not args or args[0] not in self.commands:
+            args = ['send', *args]
+        return super().parse_args(ctx, args)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
 
 ### REQUIRED OPTIONS ###
 @click.option('-F', '--from', 'fromh', required=True, type=Email(), help='set the From: header')
 @click.option('-S', '--subject', required=True, help='set the Subject: header')
-@click.option('-Z', '--server', required=True, help='the SMTP server to use')
+@click.option('-Z', '--server', multiple=True, metavar='RELAY',
+              help='the SMTP server to use, as [SCHEME://]ADDRESS[,weight=N][,user=USER]'
+                   '[,password=PASSWORD]. SCHEME is smtp (host:port, with STARTTLS, the default), '
+                   'smtps (host:port, with implicit TLS), lmtp (a UNIX socket or host:port), '
+                   'sendmail (the path of a sendmail binary), file (a directory to write the '
+                   'messages to) or null (throw the messages away). '
+                   'Repeat to spread messages among several servers, weight sets the number of '
+                   'parallel connections to a server. Required unless --check is given')
 @click.option('-P', '--parameter', 'parameter_file', required=True, type=FILETYPE,
-              help='set the parameter file (see above for an example)')
+              help='set the parameter file (see above for an example), "-" for stdin')
 @click.option('-B', '--body', 'body_file', required=True, type=FILETYPE,
               help='set the email body file (see above for an example)')
 
@@ -305,10 +1693,52 @@ class Email(click.ParamType):
 @click.option('-p', '--password', help='SMTP password. If not set you will be prompted for one')
 @click.option('-a', '--attachment', help='add attachment [repeat for multiple attachments]',
               multiple=True, type=ATTACHMENT_TYPE)
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True,
+              help='render messages in parallel using this many processes')
+@click.option('-s', '--suppress', type=INFILE_TYPE,
+              help='do not send to the addresses in this file: either a list with one address per line '
+                   'or an index built with "massmail suppress-index"')
+@click.option('-D', '--dedupe', type=click.Choice(DEDUPE_POLICIES), default='warn', show_default=True,
+              help='what to do with addresses found in more than one row: warn about them, '
+                   'only send to the first occurrence, or fail')
+@click.option('-k', '--shard', type=Shard(), metavar='K/N',
+              help='only send the K-th of N disjoint subsets of the rows, e.g. to split a campaign '
+                   'among processes or hosts')
+@click.option('--shard-by', type=click.Choice(SHARD_BY), default='row', show_default=True,
+              help='assign rows to shards round robin, or by a hash of their first address: rows with '
+                   'the same first address are then in the same shard, and --dedupe finds them')
+@click.option('--connect-timeout', type=click.FloatRange(min=0, min_open=True),
+              default=DEFAULT_TIMEOUTS.connect, show_default=True,
+              help='seconds to wait for the connection to the server')
+@click.option('--command-timeout', type=click.FloatRange(min=0, min_open=True),
+              default=DEFAULT_TIMEOUTS.command, show_default=True,
+              help='seconds to wait for the server to reply to a command')
+@click.option('--data-timeout', type=click.FloatRange(min=0, min_open=True),
+              default=DEFAULT_TIMEOUTS.data, show_default=True,
+              help='seconds to wait for the server to receive and accept a message')
+@click.option('--format', 'fmt', type=click.Choice(PARAMETER_FORMATS),
+              help='format of the parameter file: CSV, JSON Lines (one object per line) or a SQLite '
+                   'database. Guessed from the extension (.jsonl, .ndjson, .db, .sqlite, .sqlite3) '
+                   'if not set, otherwise CSV')
+@click.option('-q', '--query',
+              help='the SQL query selecting the rows from the SQLite database given as parameter file')
+@click.option('-y', '--yes', is_flag=True, default=False,
+              help='send without asking for confirmation, needed with parameters from stdin')
+@click.option('--state', type=click.Path(dir_okay=False, path_type=pathlib.Path),
+              help='remember a fingerprint of every row sent in this file, see --only-changed. Rows are '
+                   'remembered even if sending fails later on. Can not be used with --shard')
+@click.option('--only-changed', is_flag=True, default=False,
+              help='only send the rows that are new or changed since they were sent last, according to '
+                   '--state. A row changes when its values, the body, the headers or the attachments do')
+@click.option('-C', '--check', is_flag=True, default=False,
+              help='do not send anything, only check all rows and print all problems found as JSON lines')
+@click.option('-m', '--max-size', type=click.IntRange(min=1), default=MAX_MESSAGE_SIZE, show_default=True,
+              help='maximum size in bytes of a single message, used with --check')
 
 ### MAIN SCRIPT ###
 def main(fromh, subject, server, parameter_file, body_file, bcc, cc, flip_bcc, delimiter, inreply_to,
-         user, password, attachment):
+         user, password, attachment, jobs, suppress, dedupe, shard, shard_by, connect_timeout,
+         command_timeout, data_timeout, fmt, query, yes, state, only_changed, check, max_size):
     """Send mass mail
 
     Values from the parameter file (parm.csv) are inserted in the body text (body.txt). The keyword $EMAIL$ must always be present in the parameter files and contains a comma separated list of email addresses. Keep in mind shell escaping when setting headers with white spaces or special characters. Both files must be UTF8 encoded!
@@ -337,23 +1767,330 @@ def main(fromh, subject, server, parameter_file, body_file, bcc, cc, flip_bcc, d
     Notes:
 
     Attachments can be also inserted using the key $ATTACHMENT$ in the parameter file (mutiple attachments must be comma-separated)
+
+    Instead of CSV, the parameter file can be in JSON Lines format, one object per row like {"$NAME$": "John", "$EMAIL$": ["j@monkeys.com"]}, or a SQLite database with a query selecting the rows (--query). Keys and columns can also be named without dollars, "email" is the same as "$EMAIL$"
+
+    Several campaigns can be sent at once with "massmail batch", see "massmail batch -h"
     """
-    # collect parameters and body
-    keys, items = parse_parameter_file(parameter_file, delimiter)
-    body = parse_body(body_file, keys)
+    try:
+        parameter_format(parameter_file, fmt, query)
+    except click.BadParameter as err:
+        raise click.BadParameter(err.message, param_hint="'-P' / '--parameter'")
+    if only_changed and state is None:
+        raise click.BadParameter('needs --state', param_hint="'--only-changed'")
+    if state is not None and shard is not None:
+        # every shard would overwrite the rows sent by the others
+        raise click.BadParameter('can not be used with --shard', param_hint="'--state'")
+    if not server and not check:
+        raise click.MissingParameter(param_hint="'-Z' / '--server'", param_type='option')
+    if str(parameter_file) == '-' and not (yes or check):
+        # the confirmation would be read from the parameters
+        raise click.BadParameter('reading the parameters from stdin needs --yes', param_hint="'-P' / '--parameter'")
+    suppress = suppress and load_suppression_list(suppress)
+    if check:
+        problems = check_files(parameter_file, body_file, fromh, subject, cc, bcc, inreply_to,
+                               attachment, flip_bcc, delimiter=delimiter, suppress=suppress,
+                               dedupe=dedupe, max_size=max_size, jobs=jobs, shard=shard,
+                               shard_by=shard_by, fmt=fmt, query=query)
+        for problem in problems:
+            click.echo(json.dumps(problem, ensure_ascii=False))
+        if problems:
+            raise click.ClickException(f'Found {len(problems)} problem(s)')
+        click.echo('No problems found', err=True)
+        return
 
-    # verify and collect attachments
-    attachments = collect_attachments(attachment)
+    # collect parameters, body and attachments
+    campaign = Campaign.from_files(fromh, subject, parameter_file, body_file, delimiter=delimiter,
+                                   fmt=fmt, query=query, suppress=suppress, dedupe=dedupe,
+                                   shard=shard, shard_by=shard_by, cc=cc, bcc=bcc,
+                                   inreply_to=inreply_to, attachments=attachment, flip_bcc=flip_bcc)
 
-    # get messages generator
-    msgs = create_email_bodies(body, items, fromh, subject, cc, bcc, inreply_to, attachments, flip_bcc)
+    # compare the rows with the ones sent in previous runs
+    if state is not None:
+        sent = load_state(state)
+        fingerprints = campaign.fingerprints()
+        if only_changed:
+            changed = [idx for idx, (key, fingerprint) in enumerate(fingerprints)
+                       if sent.get(key) != fingerprint]
+            if unchanged := len(fingerprints) - len(changed):
+                rprint(f'[bold]Skipped {unchanged} row(s) unchanged since they were last sent[/bold]')
+            campaign.items = [campaign.items[idx] for idx in changed]
+            fingerprints = [fingerprints[idx] for idx in changed]
+        if not campaign.items:
+            rprint('[bold]Nothing to send[/bold]')
+            return
 
-    # login to the server
-    if user and not password:
-        prompt = 'Enter password for ' + click.style(f'{user}', bold=True) + ' on ' + click.style(f'{server.split(":")[0]}', bold=True)
-        password = click.prompt(prompt, hide_input=True)
-    server_connection = server_login(server, user, password)
+    # login to the server(s)
+    try:
+        timeouts = Timeouts(connect_timeout, command_timeout, data_timeout)
+        relays = make_relays(server, user, password, timeouts)
+    except click.BadParameter as err:
+        raise click.BadParameter(err.message, param_hint="'-Z' / '--server'")
 
     # do the real work
-    send_messages(msgs, server_connection, nmsgs=len(items))
+    if state is None:
+        with Mailer(relays) as mailer:
+            mailer.send(campaign, jobs=jobs, confirm=not yes)
+        return
+    delivered = {}
+
+    def remember(idx):
+        key, fingerprint = fingerprints[idx]
+        delivered[key] = fingerprint
+    try:
+        with Mailer(relays) as mailer:
+            mailer.send(campaign, jobs=jobs, confirm=not yes, sent=remember)
+    finally:
+        # also when we failed halfway: these rows must not be sent again
+        if delivered:
+            save_state(state, {**sent, **delivered})
+
+def make_relays(servers, user, password, timeouts=DEFAULT_TIMEOUTS):
+    # parse the relay specifications and ask for the passwords we don't have
+    relays = [parse_relay(spec, user, password, timeouts) for spec in servers]
+    for relay in relays:
+        if relay.user and not relay.password:
+            relay.password = prompt_password(relay.server, relay.user)
+    return relays
+
+def prompt_password(server, user):
+    prompt = 'Enter password for ' + click.style(f'{user}', bold=True) + ' on ' + click.style(f'{server.split(":")[0]}', bold=True)
+    return click.prompt(prompt, hide_input=True)
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.argument('jobs_file', type=INFILE_TYPE)
+@click.option('-Z', '--server', help='the SMTP server to use for all jobs')
+@click.option('-u', '--user', help='SMTP user name for all jobs')
+@click.option('-p', '--password', help='SMTP password. If not set you will be prompted for one')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True,
+              help='render messages in parallel using this many processes')
+def batch(jobs_file, server, user, password, jobs):
+    """Send several campaigns described in a jobs file
+
+    All jobs are validated first, then the first message of every job is shown
+    and a single confirmation is asked for all of them. Jobs going to the same
+    server with the same user and password share one connection.
+
+    Example jobs.toml:
+
+     \b
+     # top level options are the defaults for all jobs
+     from = "Blushing Gorilla <gorilla@jungle.com>"
+     server = "mail.example.com:587"
+     user = "user@example.com"
+
+     \b
+     [[job]]
+     subject = "Invitation to the jungle"
+     parameter = "parm.csv"
+     body = "body.txt"
+
+     \b
+     [[job]]
+     subject = "Jungle party"
+     parameter = "party.csv"
+     body = "party.txt"
+     attachment = ["map.pdf"]
+
+    Jobs accept these options of the massmail command, by their long name:
+    from, subject, server, parameter, body, bcc, cc, flip-bcc, delimiter,
+    inreply-to, user, password, attachment, suppress, dedupe, format, query,
+    connect-timeout, command-timeout and data-timeout. Relative paths are
+    relative to the directory of the jobs file.
+    """
+    # command line options have precedence over the jobs file
+    jobs_list = parse_jobs_file(jobs_file, job_overrides(server, user, password))
+
+    # validate everything before asking for confirmation
+    campaigns = campaigns_from_jobs(jobs_list, jobs_file.name)
+
+    if not any(len(campaign) for campaign in campaigns):
+        rprint('[bold]Nothing to send[/bold]')
+        return
+
+    # one connection for every server/user/password, see mailer_key. Ask for the
+    # passwords now, not in the middle of sending
+    mailers = {}
+    keys = []
+    for job in jobs_list:
+        key = mailer_key(job)
+        if key not in mailers:
+            mailers[key] = Mailer(make_relays(*key))
+        keys.append(key)
+
+    tease_campaigns([(campaign.preview(), len(campaign)) for campaign in campaigns if len(campaign)])
+
+    try:
+        for key, campaign in zip(keys, campaigns):
+            if len(campaign):
+                mailers[key].send(campaign, jobs=jobs, confirm=False)
+    finally:
+        for mailer in mailers.values():
+            mailer.close()
+
+
+def status_path(jobs_file):
+    # the status of spool/job.toml is in spool/job.status.json
+    return jobs_file.with_name(f'{jobs_file.stem}.status.json')
+
+def claim_job(jobs_file):
+    # create the status file of a job, unless it exists already: the job has then
+    # been taken, by us or by another daemon on the same spool. Return its path,
+    # or None
+    path = status_path(jobs_file)
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+    return path
+
+def _now():
+    return datetime.datetime.now().astimezone().isoformat(timespec='seconds')
+
+def warm_mailer(mailers, lock, job):
+    # get the Mailer for the servers and user of a job, creating it on first use.
+    # Mailers keep their connections open between jobs, and are shared by the
+    # threads sending jobs at the same time. Relays disabled by a previous job
+    # are used again after RELAY_COOLDOWN seconds
+    key = mailer_key(job)
+    with lock:
+        if key not in mailers:
+            relays = [parse_relay(spec, *key[1:]) for spec in key[0]]
+            for relay in relays:
+                if relay.user and not relay.password:
+                    # nobody to ask for it
+                    raise click.ClickException(f'No password for {relay.user} on {relay.server}')
+            mailers[key] = Mailer(relays)
+        for relay in mailers[key].relays:
+            relay.revive()
+        return mailers[key]
+
+def serve_job(jobs_file, status_file, overrides, mailers, lock, limiter, jobs):
+    # send all campaigns of a jobs file for serve, keeping its status file up to date
+    status = {'file' : jobs_file.name, 'state' : 'sending', 'started' : _now(), 'finished' : None,
+              'messages' : None, 'sent' : 0, 'error' : None}
+    write_json(status_file, status)
+    rprint(f'[bold]{jobs_file.name}[/bold]: sending')
+    try:
+        jobs_list = parse_jobs_file(jobs_file, overrides)
+        campaigns = campaigns_from_jobs(jobs_list, jobs_file.name)
+        status['messages'] = sum(len(campaign) for campaign in campaigns)
+        write_json(status_file, status)
+        for job, campaign in zip(jobs_list, campaigns):
+            mailer = warm_mailer(mailers, lock, job)
+            mailer.send(campaign, jobs=jobs, confirm=False, limiter=limiter, show_progress=False)
+            status['sent'] += len(campaign)
+            write_json(status_file, status)
+        status['state'] = 'done'
+    except click.ClickException as err:
+        status['state'], status['error'] = 'failed', err.format_message()
+    except Exception as err:
+        # whatever happens, the daemon goes on with the next job
+        status['state'], status['error'] = 'failed', f'{type(err).__name__} {err}'
+    status['finished'] = _now()
+    write_json(status_file, status)
+    if status['error'] is None:
+        rprint(f'[bold]{jobs_file.name}[/bold]: done, {status["sent"]} messages sent')
+    else:
+        rprint(f'[bold]{jobs_file.name}[/bold]: [red]failed[/red] after {status["sent"]} messages: '
+               f'{status["error"]}')
+
+
+@click.command(context_settings=CONTEXT_SETTINGS)
+@click.option('--spool', required=True, type=click.Path(exists=True, file_okay=False, path_type=pathlib.Path),
+              help='the directory to watch for jobs files')
+@click.option('-Z', '--server', help='the SMTP server to use for all jobs')
+@click.option('-u', '--user', help='SMTP user name for all jobs')
+@click.option('-p', '--password', help='SMTP password. If not set with --user you will be prompted for one')
+@click.option('--rate', type=click.FloatRange(min=0, min_open=True),
+              help='send at most this many messages per second, for all jobs together')
+@click.option('--concurrency', type=click.IntRange(min=1), default=1, show_default=True,
+              help='send at most this many jobs at the same time')
+@click.option('--poll', type=click.FloatRange(min=0, min_open=True), default=5, show_default=True,
+              help='seconds between looks for new jobs in the spool directory')
+@click.option('--once', is_flag=True, default=False,
+              help='send the jobs in the spool directory and exit, instead of waiting for more')
+@click.option('-j', '--jobs', type=click.IntRange(min=1), default=1, show_default=True,
+              help='render messages in parallel using this many processes')
+def serve(spool, server, user, password, rate, concurrency, poll, once, jobs):
+    """Send the jobs files put in a spool directory
+
+    Every file *.toml in the spool directory is a jobs file, like for
+    "massmail batch". Messages are sent without asking for confirmation.
+    Connections stay open between jobs, so that jobs going to the same server
+    don't connect and login again.
+
+    The status of job.toml is written to job.status.json in the spool
+    directory: its state is queued, sending, done or failed. Jobs with a status
+    file are not sent again: remove it to send a job once more. Write jobs
+    files under a different name and rename them to *.toml when complete, so
+    that half written files are not picked up.
+    """
+    import concurrent.futures
+
+    if user is not None and password is None:
+        password = prompt_password(server or 'all servers', user)
+    overrides = job_overrides(server, user, password)
+    limiter = rate and RateLimiter(rate)
+    mailers = {}
+    lock = threading.Lock()
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    queued = {}
+    cancel = False
+    # stop on SIGTERM like on Ctrl-C
+    sigterm = signal.signal(signal.SIGTERM, signal.default_int_handler)
+    rprint(f'[bold]Watching {spool} for jobs[/bold]')
+    try:
+        while True:
+            for jobs_file in sorted(spool.glob('*.toml')):
+                status_file = claim_job(jobs_file)
+                if status_file is None:
+                    continue
+                write_json(status_file, {'file' : jobs_file.name, 'state' : 'queued',
+                                         'queued' : _now()})
+                future = pool.submit(serve_job, jobs_file, status_file, overrides, mailers, lock,
+                                     limiter, jobs)
+                queued[future] = status_file
+            queued = {future : path for future, path in queued.items() if not future.done()}
+            if once:
+                break
+            time.sleep(poll)
+    except KeyboardInterrupt:
+        rprint('[bold]Stopping after the jobs being sent[/bold]')
+        cancel = True
+    finally:
+        signal.signal(signal.SIGTERM, sigterm)
+        pool.shutdown(wait=True, cancel_futures=cancel)
+        # jobs that never started are sent again on the next start
+        for future, status_file in queued.items():
+            if future.cancelled():
+                status_file.unlink()
+        for mailer in mailers.values():
+            mailer.close()
+
+
+@click.command('suppress-index', context_settings=CONTEXT_SETTINGS)
+@click.argument('addresses', type=INFILE_TYPE)
+@click.argument('index', type=click.Path(dir_okay=False, writable=True, path_type=pathlib.Path))
+def suppress_index(addresses, index):
+    """Build a suppression index from a list of email addresses
+
+    ADDRESSES has one email address per line, empty lines and lines starting
+    with # are ignored. Pass the resulting INDEX to "massmail --suppress": it is
+    memory-mapped and looked up in constant time, so that huge suppression lists
+    don't need to be validated again on every run.
+    """
+    count = build_suppression_index(read_address_list(addresses), index)
+    rprint(f'[bold]Wrote {count} addresses to {index}[/bold]')
+
+
+@click.group(cls=DefaultGroup, context_settings=CONTEXT_SETTINGS)
+def cli():
+    """Send mass mail"""
+
+cli.add_command(main, 'send')
+cli.add_command(batch)
+cli.add_command(serve)
+cli.add_command(suppress_index)
 
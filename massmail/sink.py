@@ -0,0 +1,221 @@
+"""A local SMTP server that accepts messages and throws them away, for load tests
+
+It behaves like a (slow, unreliable) relay on demand: replies can be delayed,
+the number of connections limited, a share of the messages refused with
+temporary (4xx) or permanent (5xx) errors, and connections dropped after some
+messages. Counters of what happened are printed periodically and on exit.
+
+Run it with:
+
+    python -m massmail.sink --listen 127.0.0.1:8025 --latency 0.05 --tempfail 0.1
+"""
+import asyncio
+import random
+import signal
+import ssl
+import time
+
+import aiosmtpd.controller
+import aiosmtpd.smtp
+import click
+from rich import print as rprint
+
+
+class Stats:
+    """Counters of a Sink, updated from the thread of its event loop"""
+    FIELDS = ('connections', 'active', 'refused', 'messages', 'recipients', 'bytes', 'tempfails',
+              'permfails', 'disconnects')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # connections still active stay active
+        for field in self.FIELDS:
+            if field != 'active' or not hasattr(self, field):
+                setattr(self, field, 0)
+        self.start = time.monotonic()
+
+    def as_dict(self):
+        return {field : getattr(self, field) for field in self.FIELDS}
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return (f'{self.messages} messages ({self.messages/elapsed:.1f}/s), '
+                f'{self.recipients} recipients, {self.bytes/1024/1024:.1f} MiB, '
+                f'{self.connections} connections ({self.active} active, {self.refused} refused), '
+                f'{self.tempfails} temporary and {self.permfails} permanent failures, '
+                f'{self.disconnects} disconnects')
+
+
+class SinkHandler:
+    # the aiosmtpd handler: decides the fate of every message
+    def __init__(self, stats, tempfail=0, permfail=0, data_latency=0, disconnect_after=None,
+                 seed=None):
+        self.stats = stats
+        self.tempfail = tempfail
+        self.permfail = permfail
+        self.data_latency = data_latency
+        self.disconnect_after = disconnect_after
+        self.random = random.Random(seed)
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.data_latency:
+            await asyncio.sleep(self.data_latency)
+        draw = self.random.random()
+        if draw < self.tempfail:
+            self.stats.tempfails += 1
+            return '451 4.3.0 Injected temporary failure'
+        if draw < self.tempfail + self.permfail:
+            self.stats.permfails += 1
+            return '554 5.0.0 Injected permanent failure'
+        self.stats.messages += 1
+        self.stats.recipients += len(envelope.rcpt_tos)
+        self.stats.bytes += len(envelope.original_content or b'')
+        server.delivered += 1
+        if self.disconnect_after is not None and server.delivered >= self.disconnect_after:
+            # hang up right after accepting the message
+            server.hangup = True
+        return '250 OK'
+
+
+class SinkSMTP(aiosmtpd.smtp.SMTP):
+    # one instance for every connection
+    def __init__(self, handler, latency=0, max_connections=None, **kwargs):
+        super().__init__(handler, **kwargs)
+        self.latency = latency
+        self.max_connections = max_connections
+        self.stats = handler.stats
+        self.delivered = 0
+        self.hangup = False
+        self.counted = False
+
+    def connection_made(self, transport):
+        # also called again after STARTTLS, when we already have a transport
+        if self.transport is None:
+            if self.max_connections is not None and self.stats.active >= self.max_connections:
+                self.stats.refused += 1
+                transport.write(b'421 4.7.0 Too many connections\r\n')
+                transport.close()
+                return
+            self.counted = True
+            self.stats.connections += 1
+            self.stats.active += 1
+        super().connection_made(transport)
+
+    def connection_lost(self, error):
+        if not self.counted:
+            # refused in connection_made, aiosmtpd never knew about it
+            return
+        self.counted = False
+        self.stats.active -= 1
+        super().connection_lost(error)
+
+    def eof_received(self):
+        if not self.counted:
+            return False
+        return super().eof_received()
+
+    async def push(self, status):
+        # every reply, including the greeting, is delayed
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        await super().push(status)
+        if self.hangup:
+            self.stats.disconnects += 1
+            self.transport.close()
+
+
+class Sink(aiosmtpd.controller.Controller):
+    """The sink server, running in its own thread between start() and stop()
+
+    latency is the delay in seconds before every reply, data_latency an
+    additional delay before accepting a message. At most max_connections
+    connections are served at once, the others are refused with 421. A share
+    tempfail (permfail) of the messages is refused with a 451 (554) error, and a
+    connection is dropped after disconnect_after messages. seed makes the
+    injected failures reproducible. stats has the counters.
+    """
+    def __init__(self, hostname='127.0.0.1', port=8025, latency=0, data_latency=0,
+                 max_connections=None, tempfail=0, permfail=0, disconnect_after=None,
+                 tls_context=None, seed=None):
+        self.stats = Stats()
+        handler = SinkHandler(self.stats, tempfail=tempfail, permfail=permfail,
+                              data_latency=data_latency, disconnect_after=disconnect_after,
+                              seed=seed)
+        self.latency = latency
+        self.max_connections = max_connections
+        super().__init__(handler, hostname=hostname, port=port, tls_context=tls_context)
+
+    def factory(self):
+        return SinkSMTP(self.handler, latency=self.latency, max_connections=self.max_connections,
+                        **self.SMTP_kwargs)
+
+    def start(self):
+        super().start()
+        # don't count the connection used by aiosmtpd to check that we are up
+        self.stats.reset()
+
+
+def parse_listen(context, param, value):
+    host, sep, port = value.rpartition(':')
+    if not sep or not port.isdigit():
+        raise click.BadParameter(f'must be HOST:PORT, not {value!r}')
+    return host, int(port)
+
+
+@click.command(context_settings={'help_option_names': ['-h', '--help'], 'max_content_width': 120})
+@click.option('-l', '--listen', default='127.0.0.1:8025', show_default=True, callback=parse_listen,
+              help='address and port to listen on, as HOST:PORT')
+@click.option('--latency', type=click.FloatRange(min=0), default=0, show_default=True,
+              help='seconds to wait before every reply')
+@click.option('--data-latency', type=click.FloatRange(min=0), default=0, show_default=True,
+              help='additional seconds to wait before accepting a message')
+@click.option('--max-connections', type=click.IntRange(min=1),
+              help='refuse connections beyond this many with 421')
+@click.option('--tempfail', type=click.FloatRange(min=0, max=1), default=0, show_default=True,
+              help='share of messages refused with a temporary failure (451)')
+@click.option('--permfail', type=click.FloatRange(min=0, max=1), default=0, show_default=True,
+              help='share of messages refused with a permanent failure (554)')
+@click.option('--disconnect-after', type=click.IntRange(min=1),
+              help='drop a connection after accepting this many messages on it')
+@click.option('--tlscert', type=click.Path(exists=True, dir_okay=False),
+              help='certificate to offer STARTTLS with, needs --tlskey')
+@click.option('--tlskey', type=click.Path(exists=True, dir_okay=False),
+              help='private key of the certificate')
+@click.option('--seed', type=int, help='seed for the injected failures')
+@click.option('--report', type=click.FloatRange(min=0, min_open=True), default=10, show_default=True,
+              help='seconds between reports of the counters')
+def main(listen, latency, data_latency, max_connections, tempfail, permfail, disconnect_after,
+         tlscert, tlskey, seed, report):
+    """Accept SMTP connections and throw the messages away, for load tests"""
+    if tempfail + permfail > 1:
+        raise click.BadParameter('the sum of --tempfail and --permfail must be at most 1')
+    if (tlscert is None) != (tlskey is None):
+        raise click.BadParameter('--tlscert and --tlskey must be given together')
+    tls_context = None
+    if tlscert is not None:
+        tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        tls_context.load_cert_chain(tlscert, tlskey)
+
+    host, port = listen
+    sink = Sink(host, port, latency=latency, data_latency=data_latency,
+                max_connections=max_connections, tempfail=tempfail, permfail=permfail,
+                disconnect_after=disconnect_after, tls_context=tls_context, seed=seed)
+    sink.start()
+    click.echo(f'Sink is listening on {host}:{port}')
+    # also print the totals when terminated
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        while True:
+            time.sleep(report)
+            rprint(sink.stats.report())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.stop()
+        rprint(f'[bold]Total:[/bold] {sink.stats.report()}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,17 @@
 import csv
 import email as email_module
 import fileinput
+import json
 import os
 import subprocess
 import sys
 import types
 
 from massmail.massmail import main as massmail
-from massmail.massmail import parse_parameter_file, send_messages, server_login
+from massmail.massmail import cli as massmail_cli
+from massmail.massmail import (load_suppression_list, parse_parameter_file, parse_relay, send_messages,
+                               server_login)
+from massmail import Campaign, Mailer
 import click
 import click.testing
 import pytest
@@ -677,10 +681,10 @@ def test_non_fatal_server_problems(server, capsys):
     # It is hard to setup a test SMTP server that does this, so instead we
     # monkey patch the server here so that it returns what we want
     lserver = server_login('localhost:8025', None, None)
-    old_send_message = lserver.send_message
-    def broken_send_message(self, msg):
+    old_sendmail = lserver.sendmail
+    def broken_sendmail(self, from_addr, to_addrs, msg, mail_options=()):
         return {'broken@test.com' : (550, "User unknown")}
-    lserver.send_message = types.MethodType(broken_send_message, lserver)
+    lserver.sendmail = types.MethodType(broken_sendmail, lserver)
     # create a valid message this time
     msg = email_module.message.EmailMessage()
     msg.set_content('test')
@@ -693,4 +697,784 @@ def test_non_fatal_server_problems(server, capsys):
     assert "User unknown" in stdout
     assert '550' in stdout
     # repair the server (not needed, but who knows?)
-    lserver.send_message = old_send_message
+    lserver.sendmail = old_sendmail
+
+def test_parallel_rendering(server, parm, body, tmp_path):
+    with parm.open('at', encoding='utf8') as parmf:
+        for idx in range(9):
+            parmf.write(f'\nÜni{idx};Smith;Mario Rossi <j{idx}@monkeys.com>')
+    attachment = tmp_path / 'dummy'
+    attachment.write_bytes(b'\x9diou\xd5\x12\xdf/\x03\xf8')
+    opts = {'--jobs' : '3', '--bcc' : 'x@monkeys.com', '-a' : str(attachment)}
+    protocol, emails = cli(server, parm, body, opts=opts)
+    assert len(emails) == 10
+    assert 'recip: x@monkeys.com' in protocol
+    # messages are sent in the same order as the rows in the parameter file
+    assert emails[0]['To'] == 'donkeys@jungle.com'
+    assert 'Dear Alice Joyce' in emails[0].get_body().get_content()
+    for idx, email in enumerate(emails[1:]):
+        assert email['To'] == f'Mario Rossi <j{idx}@monkeys.com>'
+        assert f'Dear Üni{idx} Smith' in email.get_body().get_content()
+        assert 'Bcc' not in email
+        assert list(email.iter_attachments())[0].get_content() == b'\x9diou\xd5\x12\xdf/\x03\xf8'
+    assert len({email['Message-ID'] for email in emails}) == 10
+
+# modules that are slow to import and are not needed to print the help or to
+# report validation errors
+SLOW_IMPORTS = {'concurrent.futures', 'email.message', 'mimetypes', 'rich.panel', 'rich.progress',
+                'rich.prompt', 'smtplib'}
+# generous upper bound (in microseconds) for importing massmail.massmail
+IMPORT_BUDGET = 500_000
+
+def importtime(*args):
+    # run massmail in a fresh interpreter and collect the cumulative import
+    # time in microseconds of every module that gets imported
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           'from massmail.massmail import cli; cli()', *args],
+                          capture_output=True, text=True)
+    modules = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and not line.endswith('package'):
+            _, cumulative, name = line.split('|')
+            modules[name.strip()] = int(cumulative)
+    return proc, modules
+
+def test_importtime_help():
+    proc, modules = importtime('-h')
+    assert proc.returncode == 0
+    assert 'Usage:' in proc.stdout
+    assert not (SLOW_IMPORTS | {'email_validator'}) & set(modules)
+    assert modules['massmail.massmail'] < IMPORT_BUDGET
+
+def test_importtime_validation(parm, body):
+    parm.write_text("""$NAME;$SURNAME$;$EMAIL$
+                    test;test;test@test.com""")
+    proc, modules = importtime('--from', 'gorilla@jungle.com', '--subject', 'test',
+                               '--server', '127.0.0.1:8025', '--parameter', str(parm),
+                               '--body', str(body))
+    assert proc.returncode != 0
+    assert 'malformed' in proc.stderr
+    assert not SLOW_IMPORTS & set(modules)
+    assert modules['massmail.massmail'] < IMPORT_BUDGET
+
+def test_library_api(server):
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'},
+            {'$NAME$' : 'John', '$EMAIL$' : ['j@monkeys.com', 'Mario Rossi <m@monkeys.com>']}]
+    first = Campaign.from_rows('gorilla@jungle.com', 'First', 'Dear $NAME$', rows)
+    second = Campaign.from_rows('gorilla@jungle.com', 'Second', 'Hello $NAME$', rows[:1],
+                                cc='x@monkeys.com')
+    assert len(first) == 2
+    with Mailer('127.0.0.1:8025') as mailer:
+        mailer.send(first, confirm=False)
+        mailer.send(second, confirm=False)
+    protocol, emails = parse_smtp(server)
+    # both campaigns went through the same connection
+    assert protocol.count('STARTTLS') == 1
+    assert [email['Subject'] for email in emails] == ['First', 'First', 'Second']
+    assert emails[1]['To'] == 'j@monkeys.com, Mario Rossi <m@monkeys.com>'
+    assert emails[2]['Cc'] == 'x@monkeys.com'
+    assert 'Hello Alice' in emails[2].get_content()
+
+def test_library_api_validation():
+    with pytest.raises(click.ClickException, match='Line 2 in <rows> malformed'):
+        Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$',
+                           [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'},
+                            {'$NAME$' : 'John'}])
+    with pytest.raises(click.ClickException, match='Unknown key'):
+        Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $SURNAME$',
+                           [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'}])
+
+@pytest.fixture
+def jobs(tmp_path, parm, body):
+    party = tmp_path / 'party.txt'
+    party.write_text('Hi $NAME$, party tonight!')
+    jobs = tmp_path / 'jobs.toml'
+    jobs.write_text(f'''
+from = "Blushing Gorilla <gorilla@jungle.com>"
+server = "127.0.0.1:8025"
+
+[[job]]
+subject = "Invitation to the jungle"
+parameter = "{parm.name}"
+body = "{body.name}"
+
+[[job]]
+subject = "Jungle party"
+parameter = "{parm.name}"
+body = "{party.name}"
+cc = "x@monkeys.com"
+''')
+    yield jobs
+
+def test_batch(server, jobs):
+    result = click.testing.CliRunner().invoke(massmail_cli, ['batch', str(jobs)], input='y\n')
+    protocol, emails = parse_smtp(server)
+    assert result.exit_code == 0
+    # a single confirmation for all jobs
+    assert 'About to send 2 email messages in 2 campaigns' in result.output
+    assert result.output.count('Send?') == 1
+    # both jobs went through the same connection
+    assert protocol.count('STARTTLS') == 1
+    assert 'recip: x@monkeys.com' in protocol
+    assert [email['Subject'] for email in emails] == ['Invitation to the jungle', 'Jungle party']
+    assert 'Dear Alice Joyce' in emails[0].get_content()
+    assert 'Hi Alice, party tonight!' in emails[1].get_content()
+
+def test_batch_validates_all_jobs_first(server, jobs):
+    # break the body of the second job
+    (jobs.parent / 'party.txt').write_text('Hi $UNKNOWN$')
+    result = click.testing.CliRunner().invoke(massmail_cli, ['batch', str(jobs)], input='y\n')
+    assert result.exit_code != 0
+    assert 'Job 2 in jobs.toml' in result.output
+    assert 'Unknown key(s)' in result.output
+    assert 'Send?' not in result.output
+
+def test_batch_password_before_confirmation(server, jobs):
+    jobs.write_text('user = "noone"\n' + jobs.read_text())
+    result = click.testing.CliRunner().invoke(massmail_cli, ['batch', str(jobs)], input='pass\nn\n')
+    assert result.exit_code != 0
+    # a single prompt for both jobs, before anything is shown
+    assert result.output.count('Enter password for noone') == 1
+    assert result.output.index('Enter password') < result.output.index('Send?')
+
+def test_batch_shares_connections(jobs):
+    from massmail.massmail import JOB_OPTIONS, mailer_key, parse_jobs_file
+    jobs.write_text('user = "noone"\npassword = "first"\n' + jobs.read_text())
+    first, second = parse_jobs_file(jobs)
+    assert mailer_key(first) == mailer_key(second)
+    # the command line has precedence over the jobs file
+    first, second = parse_jobs_file(jobs, {'server' : ['127.0.0.1:8026', '127.0.0.1:8027']})
+    assert mailer_key(first)[0] == ('127.0.0.1:8026', '127.0.0.1:8027')
+    # the same user with another password needs another login
+    jobs.write_text(jobs.read_text() + 'password = "second"\n')
+    first, second = parse_jobs_file(jobs)
+    assert mailer_key(first) != mailer_key(second)
+    # all options are documented
+    assert set(JOB_OPTIONS) <= {word.strip(',.') for word in massmail_cli.commands['batch'].help.split()}
+
+def test_batch_nothing_to_send(server, jobs):
+    (jobs.parent / 'suppress.txt').write_text('donkeys@jungle.com\n')
+    jobs.write_text('suppress = "suppress.txt"\n' + jobs.read_text())
+    result = click.testing.CliRunner().invoke(massmail_cli, ['batch', str(jobs)])
+    assert result.exit_code == 0
+    assert 'Nothing to send' in result.output
+    assert 'Send?' not in result.output
+
+def test_jobs_timeouts(jobs):
+    import threading
+    from massmail.massmail import DEFAULT_TIMEOUTS, parse_jobs_file, warm_mailer
+    jobs.write_text('connect-timeout = 5\n' + jobs.read_text() + 'data-timeout = 60.5\n')
+    first, second = parse_jobs_file(jobs)
+    mailers, lock = {}, threading.Lock()
+    assert warm_mailer(mailers, lock, first).relays[0].timeouts == (5, DEFAULT_TIMEOUTS.command,
+                                                                      DEFAULT_TIMEOUTS.data)
+    assert warm_mailer(mailers, lock, second).relays[0].timeouts == (5, DEFAULT_TIMEOUTS.command, 60.5)
+    jobs.write_text('command-timeout = "long"\n' + jobs.read_text())
+    with pytest.raises(click.ClickException, match='command-timeout must be a positive number'):
+        parse_jobs_file(jobs)
+
+def test_cli_defaults_to_send(server, parm, body):
+    result = click.testing.CliRunner().invoke(massmail_cli, ['-h'])
+    assert result.exit_code == 0
+    assert 'Example:' in result.output
+    result = click.testing.CliRunner().invoke(massmail_cli,
+                                              ['--from', 'gorilla@jungle.com', '--subject', 'test',
+                                               '--server', '127.0.0.1:8025', '-P', str(parm),
+                                               '-B', str(body)], input='y\n')
+    protocol, emails = parse_smtp(server)
+    assert result.exit_code == 0
+    assert 'Dear Alice Joyce' in emails[0].get_content()
+
+@pytest.fixture
+def suppress(tmp_path):
+    suppress = tmp_path / 'suppress.txt'
+    suppress.write_text('# unsubscribed\nJ@Monkeys.com\n\nGorilla <m@monkeys.com>\n')
+    yield suppress
+
+def test_suppress(server, parm, body, suppress):
+    with parm.open('at', encoding='utf8') as parmf:
+        parmf.write('\nJohn;Smith;j@monkeys.com\n')
+        parmf.write('Anne and Mary;Joyce;a@donkeys.com, m@monkeys.com\n')
+    protocol, emails, output = cli(server, parm, body, opts={'-d' : ';', '--suppress' : str(suppress)},
+                                   output=True)
+    assert 'Suppressed 2 address(es)' in output
+    assert 'Skipped 1 row(s)' in output
+    assert 'About to send 2 email messages' in output
+    assert 'recip: j@monkeys.com' not in protocol
+    assert 'recip: m@monkeys.com' not in protocol
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'a@donkeys.com']
+
+def test_suppress_index(server, parm, body, suppress, tmp_path):
+    index = tmp_path / 'suppress.idx'
+    result = click.testing.CliRunner().invoke(massmail_cli, ['suppress-index', str(suppress), str(index)])
+    assert result.exit_code == 0
+    assert 'Wrote 2 addresses' in result.output
+    lookup = load_suppression_list(index)
+    assert len(lookup) == 2
+    assert 'j@monkeys.com' in lookup
+    assert 'm@monkeys.com' in lookup
+    assert 'donkeys@jungle.com' not in lookup
+    with parm.open('at', encoding='utf8') as parmf:
+        parmf.write('\nJohn;Smith;J@monkeys.com\n')
+    protocol, emails = cli(server, parm, body, opts={'-d' : ';', '--suppress' : str(index)})
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com']
+
+def test_suppress_index_corrupted(tmp_path):
+    import struct
+    from massmail.massmail import SUPPRESSION_MAGIC
+    index = tmp_path / 'suppress.idx'
+    # truncated header, number of slots not a power of two, too small or full
+    for content in (SUPPRESSION_MAGIC + b'abc',
+                    struct.pack('<8sQQ', SUPPRESSION_MAGIC, 12, 1) + bytes(8*12),
+                    struct.pack('<8sQQ', SUPPRESSION_MAGIC, 4, 1) + bytes(8*4),
+                    struct.pack('<8sQQ', SUPPRESSION_MAGIC, 8, 8) + bytes(8*8)):
+        index.write_bytes(content)
+        with pytest.raises(click.ClickException, match='suppress.idx is corrupted'):
+            load_suppression_list(index)
+
+def test_suppress_invalid_list(server, parm, body, suppress):
+    with suppress.open('at', encoding='utf8') as suppressf:
+        suppressf.write('not an address\n')
+    output = cli(server, parm, body, opts={'--suppress' : str(suppress)}, errs=True)
+    assert 'Line 5 in suppress.txt' in output
+    assert 'is not a valid email' in output
+
+@pytest.fixture
+def dupes(parm):
+    with parm.open('at', encoding='utf8') as parmf:
+        parmf.write('\nJohn;Smith;Johnny <j@monkeys.com>\n')
+        parmf.write('Anne and Mary;Joyce;a@donkeys.com, J@monkeys.com\n')
+        parmf.write('Again;Alice;DONKEYS@jungle.com,donkeys@jungle.com\n')
+    yield parm
+
+def test_dedupe_warn(server, dupes, body):
+    protocol, emails, output = cli(server, dupes, body, opts={'-d' : ';'}, output=True)
+    assert 'Line 4 in parms.csv: duplicate address J@monkeys.com' in output
+    assert output.count('duplicate address') == 3
+    assert len(emails) == 4
+
+def test_dedupe_first(server, dupes, body):
+    opts = {'-d' : ';', '--dedupe' : 'first'}
+    protocol, emails, output = cli(server, dupes, body, opts=opts, output=True)
+    assert 'Removed 3 duplicate address(es)' in output
+    assert 'Skipped 1 row(s)' in output
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'Johnny <j@monkeys.com>',
+                                                 'a@donkeys.com']
+
+def test_dedupe_error(server, dupes, body):
+    output = cli(server, dupes, body, opts={'-d' : ';', '--dedupe' : 'error'}, errs=True)
+    assert 'Line 4 in parms.csv: duplicate address J@monkeys.com already found on line 3' in output
+
+@pytest.mark.parametrize('jobs', ['1', '2'])
+def test_check(parm, body, tmp_path, jobs):
+    large = tmp_path / 'large'
+    large.write_bytes(b'x'*2000)
+    small = tmp_path / 'small'
+    small.write_bytes(b'x'*10)
+    parm.write_text(f'''$NAME$;$EMAIL$;$ATTACHMENT$
+Alice;donkeys@jungle.com;{small}
+Mario;j@monkeys;{small}
+John;j@monkeys.com;{tmp_path / 'not_there'}
+Anne;a@donkeys.com
+Alice again;Donkeys@jungle.com;{large}
+''')
+    body.write_text('Dear $NAME$')
+    opts = ['--from', 'gorilla@jungle.com', '--subject', 'test', '--server', 'noserver:25',
+            '-P', str(parm), '-B', str(body), '-d', ';', '--check', '--jobs', jobs,
+            '--dedupe', 'error', '--max-size', '2500']
+    result = click.testing.CliRunner().invoke(massmail, opts)
+    assert result.exit_code != 0
+    assert 'Found 5 problem(s)' in result.stderr
+    problems = [json.loads(line) for line in result.stdout.splitlines()]
+    assert [problem['line'] for problem in problems] == [3, 4, 5, 6, 6]
+    assert all(problem['file'] == 'parms.csv' for problem in problems)
+    assert 'is not a valid email address' in problems[0]['error']
+    assert 'does not exist' in problems[1]['error']
+    assert '2 found instead of 3' in problems[2]['error']
+    assert 'more than the limit of 2500 bytes' in problems[3]['error']
+    assert 'duplicate address donkeys@jungle.com already found on line 2' in problems[4]['error']
+    # the first row is fine, and it was not even sent
+    assert 'Line 2' not in result.output
+
+def test_check_no_problems(server, parm, body):
+    # no server is needed to check
+    opts = ['--from', 'gorilla@jungle.com', '--subject', 'test', '-P', str(parm), '-B', str(body),
+            '--check']
+    result = click.testing.CliRunner().invoke(massmail, opts)
+    assert result.exit_code == 0
+    assert result.stdout == ''
+    assert 'No problems found' in result.stderr
+    result = click.testing.CliRunner().invoke(massmail, opts[:-1])
+    assert result.exit_code == 2
+    assert "Missing option '-Z' / '--server'" in result.stderr
+
+@pytest.fixture
+def many(parm):
+    with parm.open('at', encoding='utf8') as parmf:
+        for idx in range(6):
+            parmf.write(f'\nJohn;Smith;j{idx}@monkeys.com')
+    yield parm
+
+def test_shard_by_row(server, many, body):
+    protocol, emails, output = cli(server, many, body, opts={'--shard' : '2/3'}, output=True)
+    assert 'About to send 2 email messages' in output
+    assert [email['To'] for email in emails] == ['j0@monkeys.com', 'j3@monkeys.com']
+
+def test_shard_by_email(server, many, body):
+    recipients = []
+    for k in (1, 2):
+        opts = {'--shard' : f'{k}/2', '--shard-by' : 'email'}
+        protocol, emails = cli(server, many, body, opts=opts)
+        recipients.append({email['To'] for email in emails})
+    # every row ends up in exactly one shard
+    assert not recipients[0] & recipients[1]
+    assert len(recipients[0] | recipients[1]) == 7
+
+def test_invalid_shard(server, parm, body):
+    assert 'is not of the form K/N' in cli(server, parm, body, opts={'--shard' : '1'}, errs=True)
+    assert 'K must be between 1 and N' in cli(server, parm, body, opts={'--shard' : '3/2'}, errs=True)
+
+def test_relays_failover(server, many, body):
+    # nothing is listening on port 8029
+    opts = {'--server' : '127.0.0.1:8025,weight=2'}
+    opts_list = ['--server', '127.0.0.1:8029']
+    protocol, emails, output = cli(server, many, body, opts=opts, opts_list=opts_list, output=True)
+    assert len(emails) == 7
+    assert {email['To'] for email in emails} == {'donkeys@jungle.com'} | {f'j{idx}@monkeys.com'
+                                                                           for idx in range(6)}
+    assert 'Relay 127.0.0.1:8025: 7 sent, 0 refused, 0 errors' in output
+    assert 'Relay 127.0.0.1:8029' in output
+    assert 'Can not connect' in output
+
+def test_relays_all_failing(server, many, body):
+    opts = {'--server' : '127.0.0.1:8028'}
+    opts_list = ['--server', '127.0.0.1:8029']
+    output = cli(server, many, body, opts=opts, opts_list=opts_list, errs=True)
+    assert 'Can not send email' in output
+    assert 'Relay 127.0.0.1:8028' in output
+    assert 'Relay 127.0.0.1:8029' in output
+
+def test_parse_relay():
+    relay = parse_relay('mail.example.com:587,weight=3,user=gorilla@jungle.com', 'default', 'pass')
+    assert relay.server == 'mail.example.com:587'
+    assert relay.weight == 3
+    assert relay.user == 'gorilla@jungle.com'
+    assert relay.password == 'pass'
+    with pytest.raises(click.BadParameter, match='weight must be a positive integer'):
+        parse_relay('mail.example.com:587,weight=0')
+    with pytest.raises(click.BadParameter, match='unknown relay option'):
+        parse_relay('mail.example.com:587,speed=3')
+
+def test_connect_timeout():
+    import socket
+    from massmail.massmail import Timeouts
+    # a server that accepts the connection but never greets us
+    with socket.socket() as silent:
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        port = silent.getsockname()[1]
+        with pytest.raises(click.ClickException, match='Can not connect'):
+            server_login(f'127.0.0.1:{port}', None, None, Timeouts(0.2, 1, 1))
+
+def test_reconnect_after_timeout(server, monkeypatch):
+    import massmail.massmail
+    deliver = massmail.massmail.deliver
+    calls = []
+    def flaky(server, msg):
+        calls.append(msg)
+        if len(calls) == 2:
+            raise TimeoutError('timed out')
+        return deliver(server, msg)
+    monkeypatch.setattr(massmail.massmail, 'deliver', flaky)
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'},
+            {'$NAME$' : 'John', '$EMAIL$' : 'j@monkeys.com'}]
+    campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows)
+    with Mailer('127.0.0.1:8025') as mailer:
+        mailer.send(campaign, confirm=False)
+    protocol, emails = parse_smtp(server)
+    # the second message was sent again through a new connection
+    assert len(calls) == 3
+    assert protocol.count('STARTTLS') == 2
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'j@monkeys.com']
+
+def test_transport_file(tmp_path):
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'},
+            {'$NAME$' : 'John', '$EMAIL$' : 'j@monkeys.com'}]
+    campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows)
+    outbox = tmp_path / 'outbox'
+    with Mailer(f'file://{outbox}') as mailer:
+        mailer.send(campaign, confirm=False)
+    with Mailer('null://') as mailer:
+        mailer.send(campaign, confirm=False)
+    emails = [email_module.message_from_bytes(path.read_bytes(), policy=email_module.policy.default)
+              for path in sorted(outbox.iterdir())]
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'j@monkeys.com']
+    assert 'Dear John' in emails[1].get_content()
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs an executable script')
+def test_transport_sendmail(tmp_path, parm, body):
+    sendmail = tmp_path / 'sendmail'
+    sendmail.write_text(f'#!{sys.executable}\n'
+                        'import sys\n'
+                        f'with open({str(tmp_path / "sent")!r}, "ab") as fh:\n'
+                        '    fh.write(" ".join(sys.argv[1:]).encode() + b"\\n")\n'
+                        '    fh.write(sys.stdin.buffer.read())\n')
+    sendmail.chmod(0o755)
+    result = click.testing.CliRunner().invoke(massmail, ['-F', 'gorilla@jungle.com', '-S', 'Subject',
+                                                         '-Z', f'sendmail://{sendmail}', '-P', parm,
+                                                         '-B', body], input='y\n')
+    assert result.exit_code == 0, result.output
+    sent = (tmp_path / 'sent').read_bytes()
+    assert sent.startswith(b'-i -f gorilla@jungle.com -- donkeys@jungle.com\n')
+    assert b'\r\n' not in sent
+    assert b'Dear Alice Joyce' in sent
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs UNIX sockets')
+def test_transport_lmtp(tmp_path):
+    from aiosmtpd.controller import UnixSocketController
+    from aiosmtpd.lmtp import LMTP
+    class Handler:
+        envelopes = []
+        async def handle_DATA(self, server, session, envelope):
+            self.envelopes.append(envelope)
+            # one reply for every recipient
+            return '\r\n'.join('250 OK' for _ in envelope.rcpt_tos)
+    class Controller(UnixSocketController):
+        def factory(self):
+            return LMTP(self.handler)
+    # UNIX socket paths have to be short
+    import tempfile
+    with tempfile.TemporaryDirectory() as sockdir:
+        controller = Controller(Handler(), unix_socket=os.path.join(sockdir, 'lmtp'))
+        controller.start()
+        try:
+            rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'},
+                    {'$NAME$' : 'John', '$EMAIL$' : ['j@monkeys.com', 'm@monkeys.com']}]
+            campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows)
+            with Mailer(f'lmtp://{sockdir}/lmtp') as mailer:
+                mailer.send(campaign, confirm=False)
+        finally:
+            controller.stop()
+    assert [envelope.rcpt_tos for envelope in Handler.envelopes] == [
+                ['donkeys@jungle.com'], ['j@monkeys.com', 'm@monkeys.com']]
+
+def test_unknown_transport(server, parm, body):
+    output = cli(server, parm, body, opts={'--server' : 'carrier-pigeon://roof'}, errs=True)
+    assert 'unknown transport "carrier-pigeon"' in output
+
+@pytest.mark.parametrize('to', ['smtp', 'file'])
+def test_streamed_attachment(server, tmp_path, monkeypatch, to):
+    import massmail.massmail
+    # stream every attachment
+    monkeypatch.setattr(massmail.massmail, 'STREAM_THRESHOLD', 0)
+    monkeypatch.setattr(massmail.massmail, 'STREAM_CHUNKSIZE', 57*4)
+    big = tmp_path / 'big.bin'
+    big.write_bytes(os.urandom(10000))
+    empty = tmp_path / 'empty.txt'
+    empty.write_bytes(b'')
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com', '$ATTACHMENT$' : str(empty)}]
+    # a line starting with a dot has to be escaped
+    campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$\n.\n..see you',
+                                  rows, attachments=[big])
+    if to == 'smtp':
+        with Mailer('127.0.0.1:8025') as mailer:
+            mailer.send(campaign, confirm=False)
+        _, emails = parse_smtp(server)
+    else:
+        with Mailer(f'file://{tmp_path / "outbox"}') as mailer:
+            mailer.send(campaign, confirm=False)
+        emails = [email_module.message_from_bytes(path.read_bytes(),
+                                                  policy=email_module.policy.default)
+                  for path in (tmp_path / 'outbox').iterdir()]
+    email, = emails
+    assert 'Dear Alice\n.\n..see you' in email.get_body().get_content().replace('\r\n', '\n')
+    attachments = {part.get_filename() : part.get_payload(decode=True)
+                   for part in email.iter_attachments()}
+    assert attachments == {'big.bin' : big.read_bytes(), 'empty.txt' : b''}
+
+def test_stream_size(tmp_path, monkeypatch):
+    import massmail.massmail
+    from massmail.massmail import render_message
+    big = tmp_path / 'big.bin'
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'}]
+    for size in (1, 56, 57, 58, 1000):
+        big.write_bytes(b'x'*size)
+        monkeypatch.setattr(massmail.massmail, 'STREAM_THRESHOLD', 0)
+        stream = render_message(Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$',
+                                                   rows, attachments=[big]).preview()).data
+        assert len(stream) == len(b''.join(stream.chunks()))
+
+def test_jsonl(server, tmp_path, body):
+    parm = tmp_path / 'parms.jsonl'
+    parm.write_text('{"$NAME$": "Alice", "surname": "Joyce", "email": "donkeys@jungle.com"}\n'
+                    '{"$NAME$": "John", "surname": 1, "email": ["j@monkeys.com", "m@monkeys.com"]}\n'
+                    '\n  \n')
+    protocol, emails = cli(server, parm, body)
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'j@monkeys.com, m@monkeys.com']
+    assert 'Dear John 1,' in emails[1].get_content()
+
+def test_jsonl_invalid(server, tmp_path, body):
+    parm = tmp_path / 'parms.jsonl'
+    parm.write_text('{"$NAME$": "Alice", "$SURNAME$": "Joyce", "$EMAIL$": "donkeys@jungle.com"}\n'
+                    '{"$NAME$": "John", "$EMAIL$": "j@monkeys.com"}\n'
+                    '{"$NAME$": "John", \n')
+    output = cli(server, parm, body, errs=True)
+    assert 'Line 2 in parms.jsonl malformed' in output
+    output = cli(server, parm, body, opts_list=['--check'], errs=True)
+    problems = [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+    assert [problem['line'] for problem in problems] == [2, None]
+    assert 'Line 3 in parms.jsonl is not valid JSON' in problems[1]['error']
+    # no address at all is an error, not a row skipped like a suppressed one
+    parm.write_text('{"$NAME$": "Alice", "$SURNAME$": "Joyce", "$EMAIL$": []}\n')
+    output = cli(server, parm, body, errs=True)
+    assert "Line 1 in parms.jsonl malformed'' is not a valid email address" in output
+    # only strings and lists of strings are addresses and attachments
+    parm.write_text('{"$NAME$": "Alice", "$SURNAME$": "Joyce", "$EMAIL$": 5, "$ATTACHMENT$": []}\n'
+                    '{"$NAME$": "John", "$SURNAME$": "Smith", "$EMAIL$": ["j@monkeys.com", 1], '
+                    '"$ATTACHMENT$": []}\n'
+                    '{"$NAME$": "Mario", "$SURNAME$": "Rossi", "$EMAIL$": "m@monkeys.com", "$ATTACHMENT$": 3}\n')
+    output = cli(server, parm, body, opts_list=['--check'], errs=True)
+    problems = [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+    assert [problem['line'] for problem in problems] == [1, 2, 3]
+    assert 'Line 1 in parms.jsonl malformed: $EMAIL$ must be a string or a list of strings' in problems[0]['error']
+    assert '$EMAIL$ must be a string or a list of strings' in problems[1]['error']
+    assert '$ATTACHMENT$ must be a string or a list of strings' in problems[2]['error']
+
+def test_sqlite(server, tmp_path, body):
+    import sqlite3
+    db = tmp_path / 'people.db'
+    with sqlite3.connect(db) as conn:
+        conn.execute('CREATE TABLE people (name TEXT, surname TEXT, email TEXT, active INTEGER)')
+        conn.executemany('INSERT INTO people VALUES (?, ?, ?, ?)',
+                         [('Alice', 'Joyce', 'donkeys@jungle.com', 1), ('John', None, 'j@monkeys.com', 0),
+                          ('Mario', 'Rossi', 'm@monkeys.com', 1)])
+    conn.close()
+    query = 'SELECT name, surname AS "$SURNAME$", email FROM people WHERE active ORDER BY name'
+    protocol, emails = cli(server, db, body, opts={'--query' : query})
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com', 'm@monkeys.com']
+    output = cli(server, db, body, errs=True)
+    assert 'A query is needed' in output
+    output = cli(server, db, body, opts={'--query' : 'SELECT * FROM nowhere'}, errs=True)
+    assert 'Could not run query on people.db' in output
+
+def test_stdin(server, parm, body):
+    output = cli(server, '-', body, input=parm.read_text(), errs=True)
+    assert 'needs --yes' in output
+    protocol, emails = cli(server, '-', body, opts_list=['--yes'], input=parm.read_text())
+    assert [email['To'] for email in emails] == ['donkeys@jungle.com']
+
+@pytest.fixture
+def sink(tmp_path):
+    import ssl
+    from massmail.sink import Sink
+    (tmp_path / 'key').write_text(TLS_KEY)
+    (tmp_path / 'cert').write_text(TLS_CERT)
+    tls_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    tls_context.load_cert_chain(tmp_path / 'cert', tmp_path / 'key')
+    sinks = []
+    def start(**kwargs):
+        sinks.append(Sink('127.0.0.1', 8030, tls_context=tls_context, **kwargs))
+        sinks[-1].start()
+        return sinks[-1]
+    yield start
+    for sink in sinks:
+        sink.stop()
+
+def many_rows(n):
+    rows = [{'$NAME$' : f'j{idx}', '$EMAIL$' : f'j{idx}@monkeys.com'} for idx in range(n)]
+    return Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows)
+
+def test_sink_disconnect(sink):
+    server = sink(disconnect_after=2)
+    with Mailer('127.0.0.1:8030') as mailer:
+        mailer.send(many_rows(5), confirm=False)
+    assert server.stats.messages == 5
+    assert server.stats.disconnects == 2
+    assert server.stats.connections == 3
+
+def test_sink_failures(sink):
+    server = sink(tempfail=1)
+    with pytest.raises(click.ClickException, match='Can not send email'):
+        with Mailer('127.0.0.1:8030') as mailer:
+            mailer.send(many_rows(2), confirm=False)
+    assert server.stats.tempfails == 1
+    assert server.stats.messages == 0
+
+@pytest.mark.parametrize('relays', (['127.0.0.1:8030'], ['127.0.0.1:8030', '127.0.0.1:8030']))
+def test_permanent_failure(sink, relays, capsys):
+    # refused messages are skipped, and reported at the end. They do not count
+    # against the relays
+    server = sink(permfail=0.5, seed=1)
+    with Mailer(relays) as mailer:
+        with pytest.raises(click.ClickException) as excinfo:
+            mailer.send(many_rows(10), confirm=False)
+        assert all(not relay.disabled and relay.failures == 0 for relay in mailer.relays)
+    assert server.stats.permfails + server.stats.messages == 10
+    assert 0 < server.stats.permfails < 10
+    assert excinfo.value.format_message() == (f'Can not send email: {server.stats.permfails} '
+                                              'message(s) refused, see the warnings above')
+    assert capsys.readouterr().out.count('refused the message to') == server.stats.permfails
+
+def test_relay_weight(sink):
+    # a single relay with a weight gets as many connections
+    server = sink(latency=0.02)
+    with Mailer('127.0.0.1:8030,weight=3') as mailer:
+        mailer.send(many_rows(6), confirm=False)
+    assert server.stats.messages == 6
+    assert server.stats.connections == 3
+
+def test_sink_max_connections(sink):
+    server = sink(max_connections=1)
+    first = server_login('127.0.0.1:8030', None, None)
+    with pytest.raises(click.ClickException, match='Can not connect'):
+        server_login('127.0.0.1:8030', None, None)
+    first.quit()
+    assert server.stats.refused == 1
+
+def test_serve(server, jobs):
+    spool = jobs.parent
+    broken = spool / 'broken.toml'
+    broken.write_text(jobs.read_text().replace('body.txt', 'missing.txt'))
+    result = click.testing.CliRunner().invoke(massmail_cli, ['serve', '--spool', str(spool), '--once',
+                                                             '--rate', '100'])
+    protocol, emails = parse_smtp(server)
+    assert result.exit_code == 0, result.output
+    # no confirmation, and the connection stays open between jobs files
+    assert 'Send?' not in result.output
+    assert protocol.count('STARTTLS') == 1
+    assert [email['Subject'] for email in emails] == ['Invitation to the jungle', 'Jungle party']
+    status = json.loads((spool / 'jobs.status.json').read_text())
+    assert (status['state'], status['messages'], status['sent']) == ('done', 2, 2)
+    status = json.loads((spool / 'broken.status.json').read_text())
+    assert status['state'] == 'failed'
+    assert 'Job 1 in broken.toml' in status['error']
+    # jobs are only sent once
+    result = click.testing.CliRunner().invoke(massmail_cli, ['serve', '--spool', str(spool), '--once'])
+    assert result.exit_code == 0
+    assert 'sending' not in result.output
+
+def test_rate_limiter():
+    import time
+    from massmail.massmail import RateLimiter
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    assert list(limiter.limit(range(6))) == list(range(6))
+    assert time.monotonic() - start >= 0.1
+
+def test_relay_revive():
+    import threading
+    from massmail.massmail import JOB_OPTIONS, RELAY_COOLDOWN, RELAY_MAX_FAILURES, warm_mailer
+    mailers, lock = {}, threading.Lock()
+    job = {**JOB_OPTIONS, 'server' : '127.0.0.1:8029'}
+    relay = warm_mailer(mailers, lock, job).relays[0]
+    for _ in range(RELAY_MAX_FAILURES):
+        relay.record(error=TimeoutError())
+    assert relay.disabled
+    # the next job comes too early
+    assert warm_mailer(mailers, lock, job).relays[0].disabled
+    relay.disabled_at -= RELAY_COOLDOWN
+    assert warm_mailer(mailers, lock, job).relays[0] is relay
+    assert not relay.disabled and relay.failures == 0
+
+def test_only_changed(server, many, body, tmp_path):
+    state = tmp_path / 'state.json'
+    opts_list = ['--state', str(state), '--only-changed']
+    protocol, emails = cli(server, many, body, opts_list=opts_list)
+    assert len(emails) == 7
+    # nothing changed: we don't even connect to the server
+    result = click.testing.CliRunner().invoke(massmail, ['-F', 'Blushing Gorilla <gorilla@jungle.com>',
+                                                         '-S', 'Invitation to the jungle',
+                                                         '-Z', '127.0.0.1:8025', '-P', str(many),
+                                                         '-B', str(body), *opts_list])
+    assert result.exit_code == 0, result.output
+    assert 'Nothing to send' in result.output
+    # fix a typo in one row and add a new one
+    many.write_text(many.read_text().replace('Smith;j3@', 'Smyth;j3@') + '\nNew;Row;new@monkeys.com')
+    protocol, emails, output = cli(server, many, body, opts_list=opts_list, output=True)
+    assert [email['To'] for email in emails] == ['j3@monkeys.com', 'new@monkeys.com']
+    assert 'Skipped 6 row(s) unchanged' in output
+    # changing the body changes all rows
+    body.write_text(body.read_text() + 'PS: bring bananas')
+    protocol, emails = cli(server, many, body, opts_list=opts_list)
+    assert len(emails) == 8
+
+def test_only_changed_duplicates(server, parm, body, tmp_path):
+    # two rows for the same address are remembered separately
+    parm.write_text(parm.read_text() + '\nBob;Joyce;donkeys@jungle.com')
+    state = tmp_path / 'state.json'
+    opts_list = ['--state', str(state), '--only-changed']
+    protocol, emails = cli(server, parm, body, opts_list=opts_list)
+    assert len(emails) == 2
+    result = click.testing.CliRunner().invoke(massmail, ['-F', 'Blushing Gorilla <gorilla@jungle.com>',
+                                                         '-S', 'Invitation to the jungle',
+                                                         '-Z', '127.0.0.1:8025', '-P', str(parm),
+                                                         '-B', str(body), *opts_list])
+    assert 'Nothing to send' in result.output
+    state.write_text('{"version": 1, "rows": []}')
+    output = cli(server, parm, body, opts_list=opts_list, errs=True)
+    assert 'Could not read state file state.json' in output
+
+def test_only_changed_needs_state(server, parm, body):
+    output = cli(server, parm, body, opts_list=['--only-changed'], errs=True)
+    assert 'needs --state' in output
+    output = cli(server, parm, body, opts={'--state' : 'state.json', '--shard' : '1/2'}, errs=True)
+    assert 'can not be used with --shard' in output
+
+def test_only_changed_interrupted(many, body, tmp_path, monkeypatch):
+    from massmail.transport import FileSink
+    sendmail = FileSink.sendmail
+    def failing(self, *args):
+        if len(list(outbox.glob('*.eml'))) == 3:
+            raise TimeoutError('the disk is slow')
+        return sendmail(self, *args)
+    monkeypatch.setattr(FileSink, 'sendmail', failing)
+    outbox, state = tmp_path / 'outbox', tmp_path / 'state.json'
+    opts = ['-F', 'gorilla@jungle.com', '-S', 'Subject', '-Z', f'file://{outbox}', '-P', str(many),
+            '-B', str(body), '--yes', '--state', str(state), '--only-changed']
+    result = click.testing.CliRunner().invoke(massmail, opts)
+    assert result.exit_code != 0
+    # the rows sent before the failure are remembered
+    assert len(json.loads(state.read_text())['rows']) == 3
+    monkeypatch.setattr(FileSink, 'sendmail', sendmail)
+    result = click.testing.CliRunner().invoke(massmail, opts)
+    assert result.exit_code == 0, result.output
+    assert 'Skipped 3 row(s) unchanged' in result.output
+    assert len(list(outbox.glob('*.eml'))) == 7
+
+def test_address_lists_parsed_once(monkeypatch, tmp_path):
+    import email.headerregistry
+    import email.utils
+    from massmail.massmail import address_header
+    parsed = []
+    parser = email.headerregistry.AddressHeader.value_parser
+    getaddresses = email.utils.getaddresses
+    def counting(value):
+        parsed.append(value)
+        return parser(value)
+    def counting_getaddresses(values, *args, **kwargs):
+        parsed.append(values)
+        return getaddresses(values, *args, **kwargs)
+    monkeypatch.setattr(email.headerregistry.AddressHeader, 'value_parser', staticmethod(counting))
+    monkeypatch.setattr(email.utils, 'getaddresses', counting_getaddresses)
+    address_header.cache_clear()
+    cell = 'j@monkeys.com, Mario Rossi <m@monkeys.com>'
+    rows = [{'$NAME$' : name, '$EMAIL$' : cell} for name in ('John', 'Mario', 'Luigi')]
+    campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows,
+                                  cc='x@monkeys.com')
+    with Mailer(f'file://{tmp_path}') as mailer:
+        mailer.send(campaign, confirm=False)
+    assert len(list(tmp_path.glob('*.eml'))) == 3
+    # To, From and Cc are parsed once, not once per message
+    assert len(parsed) == 3
+
+def test_render_message_keeps_bcc():
+    from massmail.massmail import render_message
+    rows = [{'$NAME$' : 'Alice', '$EMAIL$' : 'donkeys@jungle.com'}]
+    campaign = Campaign.from_rows('gorilla@jungle.com', 'Subject', 'Dear $NAME$', rows,
+                                  bcc='b@monkeys.com', flip_bcc=True)
+    msg = campaign.preview()
+    # a message sent again after a failure goes to the same recipients
+    first, second = render_message(msg), render_message(msg)
+    assert first.recipients == second.recipients == ['donkeys@jungle.com', 'b@monkeys.com']
+    assert b'Bcc' not in first.data
+    assert msg['Bcc'] is not None
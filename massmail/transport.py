@@ -0,0 +1,170 @@
+# Connections to the servers we hand messages over to. This module is only
+# imported when we are about to connect, so that we don't pay for smtplib
+# and ssl when printing the help or failing validation.
+#
+# Every transport looks like an smtplib.SMTP object as far as massmail is
+# concerned: sendmail, send_message, noop, quit and close
+import itertools
+import os
+import re
+import smtplib
+import subprocess
+
+# numbers the messages written by FileSink, shared by all connections of the
+# process so that two of them never pick the same file name
+_FILE_COUNTER = itertools.count()
+
+class TransportError(Exception):
+    pass
+
+class _DataTimeout:
+    # the timeout given at creation is used to connect. Commands use the
+    # socket timeout set afterwards, while sending the message body and waiting
+    # for the server to accept it can take up to data_timeout seconds
+    #
+    # messages can also be a massmail.Stream, sent chunk by chunk
+    data_timeout = None
+
+    def data(self, msg):
+        if self.data_timeout is None or self.sock is None:
+            return self._data(msg)
+        timeout = self.sock.gettimeout()
+        self.sock.settimeout(self.data_timeout)
+        try:
+            return self._data(msg)
+        finally:
+            if self.sock is not None:
+                self.sock.settimeout(timeout)
+
+    def _data(self, msg):
+        if isinstance(msg, (bytes, str)):
+            return super().data(msg)
+        # what smtplib.SMTP.data does, one chunk at a time
+        code, repl = self.docmd('data')
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        end = b'\r\n'
+        for chunk in msg.chunks():
+            if not chunk:
+                continue
+            # chunks begin at the beginning of a line or with a line ending, so
+            # dots at the beginning of every line are escaped
+            self.send(re.sub(rb'(?m)^\.', b'..', chunk))
+            end = chunk[-2:]
+        self.send(b'.\r\n' if end == b'\r\n' else b'\r\n.\r\n')
+        return self.getreply()
+
+class SMTP(_DataTimeout, smtplib.SMTP):
+    """SMTP, upgraded to TLS with STARTTLS after connecting"""
+
+class SMTPS(_DataTimeout, smtplib.SMTP_SSL):
+    """SMTP over implicit TLS, usually on port 465"""
+
+class LMTP(_DataTimeout, smtplib.LMTP):
+    """LMTP to a local delivery agent, over a UNIX socket or TCP
+
+    After DATA an LMTP server replies once for every accepted recipient, while
+    smtplib only reads the first reply. We read the others too, so that the
+    connection can be used for the next message, and report the recipients the
+    server refused like refused RCPT commands.
+    """
+    def mail(self, sender, options=()):
+        self._accepted = []
+        self._refused = {}
+        return super().mail(sender, options)
+
+    def rcpt(self, recip, options=()):
+        reply = super().rcpt(recip, options)
+        if reply[0] in (250, 251):
+            self._accepted.append(recip)
+        return reply
+
+    def data(self, msg):
+        # a refused DATA command raises here, before any recipient got the message
+        reply = super().data(msg)
+        replies = [reply] + [self.getreply() for _ in self._accepted[1:]]
+        for recip, (code, resp) in zip(self._accepted, replies):
+            if code != 250:
+                self._refused[recip] = (code, resp)
+        if len(self._refused) == len(self._accepted):
+            raise smtplib.SMTPRecipientsRefused(self._refused)
+        return 250, replies[0][1]
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        senderrs = super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        senderrs.update(self._refused)
+        return senderrs
+
+class _Local:
+    # base for the transports that don't talk to a server
+    data_timeout = None
+
+    def send_message(self, msg):
+        from .massmail import render_message
+
+        msg = render_message(msg)
+        return self.sendmail(msg.sender, msg.recipients, msg.data, msg.mail_options)
+
+    def noop(self):
+        return 250, b'OK'
+
+    def quit(self):
+        self.close()
+
+    def close(self):
+        pass
+
+class Sendmail(_Local):
+    """Pipe every message to a local sendmail binary"""
+    def __init__(self, path='sendmail'):
+        self.path = path
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        if isinstance(msg, str):
+            msg = msg.encode('utf-8')
+        # sendmail wants local line endings
+        if isinstance(msg, bytes):
+            msg = msg.replace(b'\r\n', b'\n')
+        try:
+            proc = subprocess.Popen([self.path, '-i', '-f', from_addr, '--', *to_addrs],
+                                    stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+        except OSError as err:
+            raise TransportError(f'{self.path}: {err}')
+        try:
+            try:
+                for chunk in [msg] if isinstance(msg, bytes) else msg.chunks(linesep=b'\n'):
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # sendmail gave up, its exit status tells why
+                pass
+            _, stderr = proc.communicate(timeout=self.data_timeout)
+        except subprocess.TimeoutExpired as err:
+            proc.kill()
+            proc.wait()
+            raise TransportError(f'{self.path}: {err}')
+        if proc.returncode != 0:
+            stderr = stderr.decode('utf-8', 'replace').strip()
+            raise TransportError(f'{self.path} exited with status {proc.returncode}: {stderr}')
+        return {}
+
+class FileSink(_Local):
+    """Write every message to a file in a directory, or nowhere without one
+
+    This is meant for benchmarking everything but the network, and for looking
+    at what would have been sent.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=()):
+        if self.directory is not None:
+            if isinstance(msg, str):
+                msg = msg.encode('utf-8')
+            name = f'{os.getpid()}-{next(_FILE_COUNTER):06d}.eml'
+            with open(os.path.join(self.directory, name), 'wb') as fh:
+                for chunk in [msg] if isinstance(msg, bytes) else msg.chunks():
+                    fh.write(chunk)
+        return {}